@@ -0,0 +1,49 @@
+#!/usr/bin/env python3
+"""Compare phylo3.Node trees against phyarray.ArrayTree trees on randomly generated trees with
+increasing numbers of tips: the time and peak memory to parse the tree, and the time to calculate
+the depth, root distance and leaf count of every node (with annotate() for phylo3.Node)."""
+
+import argparse, newick3, phyarray, sys, time, tracemalloc
+from benchmark_newick_parse import make_random_newick
+
+def measure(parse, calculate, tree_string):
+    tracemalloc.start()
+    start = time.time()
+    tree = parse(tree_string)
+    parse_time = time.time() - start
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+
+    start = time.time()
+    calculate(tree)
+    return parse_time, peak, time.time() - start
+
+def calculate_nodes(tree):
+    tree.annotate()
+
+def calculate_arrays(tree):
+    tree.depths()
+    tree.root_distances()
+    tree.leaf_counts()
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser(description=__doc__)
+
+    parser.add_argument("-n", "--number-of-tips", type=int, nargs="+", default=[1000, 10000, 100000, 1000000], \
+        help="The tree sizes to be tested.")
+
+    parser.add_argument("-x", "--random-seed", type=int, default=1, \
+        help="A seed for generating the random trees.")
+
+    args = parser.parse_args()
+
+    print("tips\ttree\tparse seconds\tparse MB\tcalculate seconds")
+    for n in args.number_of_tips:
+        s = make_random_newick(n, args.random_seed)
+
+        for name, parse, calculate in (("Node", newick3.parse, calculate_nodes), \
+                                       ("ArrayTree", newick3.parse_arrays, calculate_arrays)):
+            parse_time, peak, calculate_time = measure(parse, calculate, s)
+            print("{0}\t{1}\t{2:.3f}\t{3:.1f}\t{4:.3f}".format(n, name, parse_time, peak / 1e6, calculate_time))
+            sys.stdout.flush()
@@ -0,0 +1,61 @@
+#!/usr/bin/env python3
+"""Compare the throughput of the single-pass newick3 scanner against the older shlex-based
+tokenizer, on randomly generated trees with increasing numbers of tips. The shlex parser is
+skipped for trees larger than --shlex-max-tips, since it is too slow to be practical there."""
+
+import argparse, newick3, random, sys, time
+
+def make_random_newick(n_tips, seed=None):
+    """Return a newick string for a random bifurcating tree with n_tips tips, built by joining
+    randomly chosen pairs of subtrees until only one remains."""
+
+    rng = random.Random(seed)
+    subtrees = ["T%d:%.6f" % (i, rng.random()) for i in range(n_tips)]
+    while len(subtrees) > 1:
+        i = rng.randrange(len(subtrees))
+        a = subtrees[i]
+        subtrees[i] = subtrees[-1]
+        subtrees.pop()
+        j = rng.randrange(len(subtrees))
+        subtrees[j] = "(%s,%s):%.6f" % (a, subtrees[j], rng.random())
+    return subtrees[0] + ";"
+
+def time_parse(tree_string, use_shlex, repeats):
+    best = None
+    for r in range(repeats):
+        start = time.time()
+        newick3.parse(tree_string, use_shlex=use_shlex)
+        elapsed = time.time() - start
+        if best is None or elapsed < best:
+            best = elapsed
+    return best
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser(description=__doc__)
+
+    parser.add_argument("-n", "--number-of-tips", type=int, nargs="+", default=[1000, 10000, 100000, 1000000], \
+        help="The tree sizes to be tested.")
+
+    parser.add_argument("-m", "--shlex-max-tips", type=int, default=100000, \
+        help="The largest tree on which the shlex parser will be timed.")
+
+    parser.add_argument("-r", "--repeats", type=int, default=3, \
+        help="The number of times to parse each tree. The best time is reported.")
+
+    parser.add_argument("-x", "--random-seed", type=int, default=1, \
+        help="A seed for generating the random trees.")
+
+    args = parser.parse_args()
+
+    print("tips\tMB\tparser\tseconds\ttips/sec\tMB/sec")
+    for n in args.number_of_tips:
+        s = make_random_newick(n, args.random_seed)
+        mb = len(s) / 1e6
+
+        for name, use_shlex in (("scanner", False), ("shlex", True)):
+            if use_shlex and n > args.shlex_max_tips:
+                continue
+            t = time_parse(s, use_shlex, args.repeats)
+            print("{0}\t{1:.2f}\t{2}\t{3:.3f}\t{4:.0f}\t{5:.2f}".format(n, mb, name, t, n / t, mb / t))
+            sys.stdout.flush()
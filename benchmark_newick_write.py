@@ -0,0 +1,75 @@
+#!/usr/bin/env python3
+"""Compare the iterative, buffered newick3 writer against the older recursive implementation of
+newick3.to_string, on random and pectinate (caterpillar) trees with increasing numbers of tips."""
+
+import argparse, io, make_balanced_tree, newick3, sys, time
+from benchmark_newick_parse import make_random_newick
+
+def recursive_to_string(node, length_fmt=":%s", use_node_labels=True, use_branch_lengths=True):
+    """The previous implementation of newick3.to_string, kept here for comparison."""
+
+    if node.istip:
+        node_str = "%s" % node.label
+
+    else:
+        node_label = ''
+        if use_node_labels and node.label != None:
+            node_label = node.label
+
+        node_str = "(%s)%s" % \
+                   (','.join([ recursive_to_string(child, length_fmt, use_node_labels, use_branch_lengths) \
+                               for child in node.children ]), node_label)
+
+    if use_branch_lengths and node.length is not None and node.length != '':
+        length_str = length_fmt % node.length
+    else:
+        length_str = ''
+
+    return "%s%s" % (node_str, length_str)
+
+def write_to_file(tree):
+    newick3.write(tree, io.StringIO())
+
+def time_writer(writer, tree, repeats):
+    best = None
+    for r in range(repeats):
+        start = time.time()
+        writer(tree)
+        elapsed = time.time() - start
+        if best is None or elapsed < best:
+            best = elapsed
+    return best
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser(description=__doc__)
+
+    parser.add_argument("-n", "--number-of-tips", type=int, nargs="+", default=[1000, 10000, 100000, 1000000], \
+        help="The tree sizes to be tested.")
+
+    parser.add_argument("-r", "--repeats", type=int, default=3, \
+        help="The number of times to write each tree. The best time is reported.")
+
+    parser.add_argument("-x", "--random-seed", type=int, default=1, \
+        help="A seed for generating the random trees.")
+
+    args = parser.parse_args()
+
+    writers = (("to_string", newick3.to_string), ("write", write_to_file), ("recursive", recursive_to_string))
+
+    print("shape\ttips\twriter\tseconds\ttips/sec")
+    for shape in ("random", "pectinate"):
+        for n in args.number_of_tips:
+            if shape == "random":
+                tree = newick3.parse(make_random_newick(n, args.random_seed))
+            else:
+                tree = make_balanced_tree.get_pectinate_tree(n, lambda x: x, 1.0)
+
+            for name, writer in writers:
+                try:
+                    t = time_writer(writer, tree, args.repeats)
+                    result = "{0:.3f}\t{1:.0f}".format(t, n / t)
+                except RecursionError:
+                    result = "failed\t(recursion limit exceeded)"
+                print("\t".join([shape, str(n), name, result]))
+                sys.stdout.flush()
@@ -0,0 +1,60 @@
+#!/usr/bin/env python3
+"""Compare the explicit-stack phylo3.Node.iternodes traversal against the older recursive
+generator (which also shuffled the children at every node), on balanced and pectinate
+(caterpillar) trees with increasing numbers of tips."""
+
+import argparse, make_balanced_tree, phylo3, random, sys, time
+
+def recursive_iternodes(node, order=phylo3.PREORDER):
+    """The previous implementation of phylo3.Node.iternodes, kept here for comparison."""
+    if order == phylo3.PREORDER:
+        yield node
+    random.shuffle(node.children)
+    for child in node.children:
+        for d in recursive_iternodes(child, order):
+            yield d
+    if order == phylo3.POSTORDER:
+        yield node
+
+def time_traversal(traversal, tree, order, repeats):
+    best = None
+    for r in range(repeats):
+        start = time.time()
+        for n in traversal(tree, order):
+            pass
+        elapsed = time.time() - start
+        if best is None or elapsed < best:
+            best = elapsed
+    return best
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser(description=__doc__)
+
+    parser.add_argument("-n", "--number-of-tips", type=int, nargs="+", default=[1000, 10000, 100000, 1000000], \
+        help="The tree sizes to be tested.")
+
+    parser.add_argument("-r", "--repeats", type=int, default=3, \
+        help="The number of times to traverse each tree. The best time is reported.")
+
+    args = parser.parse_args()
+
+    traversals = (("iternodes", phylo3.Node.iternodes), ("recursive", recursive_iternodes))
+    orders = (("preorder", phylo3.PREORDER), ("postorder", phylo3.POSTORDER))
+
+    print("shape\ttips\ttraversal\torder\tseconds\tnodes/sec")
+    for shape, make_tree in (("balanced", make_balanced_tree.get_balanced_tree), \
+                             ("pectinate", make_balanced_tree.get_pectinate_tree)):
+        for n in args.number_of_tips:
+            tree = make_tree(n, lambda x: x, 1.0)
+            n_nodes = len(list(tree.iternodes()))
+
+            for traversal_name, traversal in traversals:
+                for order_name, order in orders:
+                    try:
+                        t = time_traversal(traversal, tree, order, args.repeats)
+                        result = "{0:.3f}\t{1:.0f}".format(t, n_nodes / t)
+                    except RecursionError:
+                        result = "failed\t(recursion limit exceeded)"
+                    print("\t".join([shape, str(n), traversal_name, order_name, result]))
+                    sys.stdout.flush()
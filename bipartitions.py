@@ -0,0 +1,186 @@
+"""Classes and methods for representing the bipartitions (splits) of phylogenetic trees as bitsets,
+and for counting them over sets of trees."""
+
+import math, phylo3
+
+# conflicting bipartitions found in fewer than this proportion of the trees are not considered
+# when calculating ica, following Salichos et al. (2014)
+ICA_MIN_FREQUENCY = 0.05
+
+class BipartitionIndex():
+    """Maps tip labels to bit positions, so that any set of tips (such as one side of a bipartition)
+    can be represented as a python int with one bit set for each tip in the set. Set operations on
+    these ints take time proportional to the number of tips divided by the machine word size."""
+
+    def __init__(self, labels):
+        self.labels = []
+        self._bits = {}
+        for label in labels:
+            if label in self._bits:
+                raise ValueError("duplicate tip label '" + str(label) + "'")
+            self._bits[label] = 1 << len(self.labels)
+            self.labels.append(label)
+        self.all_bits = (1 << len(self.labels)) - 1
+
+    @classmethod
+    def for_tree(cls, tree):
+        """Return an index of the leaf labels of the tree. Labels are sorted, so that trees
+        with the same set of labels will always produce the same index."""
+        return cls(sorted([l.label for l in tree.leaves()]))
+
+    def __len__(self):
+        return len(self.labels)
+
+    def __contains__(self, label):
+        return label in self._bits
+
+    def bits_for(self, labels, ignore_missing=False):
+        """Return the bitset for a collection of labels. Unknown labels raise a KeyError,
+        unless ignore_missing is set."""
+        bits = 0
+        for label in labels:
+            if label in self._bits:
+                bits |= self._bits[label]
+            elif not ignore_missing:
+                raise KeyError(label)
+        return bits
+
+    def labels_for(self, bits):
+        """Return a list of the labels whose bits are set in bits, in index order."""
+        # the binary string representation is reversed so that position i is bit i
+        s = bin(bits)[:1:-1]
+        labels = self.labels
+        result = []
+        i = s.find('1')
+        while i >= 0:
+            result.append(labels[i])
+            i = s.find('1', i + 1)
+        return result
+
+    def node_bits(self, tree):
+        """Return a dict mapping every node in the tree to the bitset of its descendant leaves,
+        calculated in a single postorder pass. Leaves whose labels are not in the index are
+        ignored, so the bitsets of a tree containing extra taxa are restricted to the index."""
+        bits = {}
+        index = self._bits
+        for n in tree.iternodes(phylo3.POSTORDER):
+            if len(n.children) > 0:
+                b = 0
+                for c in n.children:
+                    b |= bits[c]
+                bits[n] = b
+            else:
+                bits[n] = index.get(n.label, 0) if n.istip else 0
+        return bits
+
+    def complement(self, bits, mask=None):
+        """Return the other side of the bipartition, within mask (by default all tips)."""
+        return (self.all_bits if mask is None else mask) ^ bits
+
+    def canonical(self, bits, mask=None):
+        """Return a canonical representation of the unrooted bipartition with bits on one side,
+        which is the same for both sides: whichever side does not contain the lowest set bit
+        of the mask (by default, the first label in the index). This value may be used to hash
+        bipartitions, compare them between trees, or as a key to store them."""
+        if mask is None:
+            mask = self.all_bits
+        bits &= mask
+        return mask ^ bits if bits & (mask & -mask) else bits
+
+    def is_trivial(self, bits, mask=None):
+        """Return True if either side of the bipartition has fewer than two tips."""
+        if mask is None:
+            mask = self.all_bits
+        k = count_bits(bits & mask)
+        return k < 2 or count_bits(mask) - k < 2
+
+    def same_split(self, a, b, mask=None):
+        """Return True if a and b represent the same unrooted bipartition within mask."""
+        return self.canonical(a, mask) == self.canonical(b, mask)
+
+    def is_compatible(self, a, b, mask=None):
+        """Return True if the unrooted bipartitions a and b can both occur in the same tree,
+        i.e. if one of the four intersections between their sides is empty."""
+        if mask is None:
+            mask = self.all_bits
+        a &= mask
+        b &= mask
+        a_c = mask ^ a
+        b_c = mask ^ b
+        return (a & b) == 0 or (a & b_c) == 0 or (a_c & b) == 0 or (a_c & b_c) == 0
+
+    def conflicts(self, a, b, mask=None):
+        """Return True if the unrooted bipartitions a and b cannot both occur in the same tree."""
+        return not self.is_compatible(a, b, mask)
+
+class BipartitionCounter():
+    """Counts the nontrivial bipartitions observed in a set of trees, and calculates the frequency
+    and the internode certainty all (ICA; Salichos, Stamatakis and Rokas 2014) of any bipartition
+    over them. Every tree must have a leaf for every label in the index. Bipartitions are stored
+    in canonical form, so counting takes one postorder pass per tree, and looking up the frequency
+    of a bipartition takes constant time."""
+
+    def __init__(self, index, trees=None):
+        self.index = index
+        self.counts = {}
+        self.ntrees = 0
+        if trees is not None:
+            for tree in trees:
+                self.add_tree(tree)
+
+    def add_tree(self, tree):
+        """Count each distinct nontrivial bipartition of the tree once."""
+        index = self.index
+        bits = index.node_bits(tree)
+        if bits[tree] != index.all_bits:
+            raise ValueError("the tree does not contain every label in the index")
+
+        found = set()
+        for n, b in bits.items():
+            if n is not tree and not index.is_trivial(b):
+                found.add(index.canonical(b))
+        for c in found:
+            self.counts[c] = self.counts.get(c, 0) + 1
+        self.ntrees += 1
+
+    def count(self, bits):
+        """Return the number of trees that have the bipartition with bits on one side."""
+        return self.counts.get(self.index.canonical(bits), 0)
+
+    def frequency(self, bits):
+        """Return the proportion of trees that have the bipartition with bits on one side."""
+        return float(self.count(bits)) / self.ntrees if self.ntrees > 0 else 0.0
+
+    def conflicting(self, bits):
+        """Return a list of (canonical bits, count) tuples for the observed bipartitions that
+        conflict with the bipartition with bits on one side."""
+        return [(c, k) for c, k in self.counts.items() if self.index.conflicts(bits, c)]
+
+    def ica(self, bits, min_frequency=ICA_MIN_FREQUENCY):
+        """Return the ICA of the bipartition with bits on one side: 1 + sum(p log_n p) over it and
+        the n - 1 bipartitions that conflict with it and are found in at least min_frequency of
+        the trees, where p is the count of each divided by the sum of their counts. It is
+        negative if any of the conflicting bipartitions is more common, and 1 if none are
+        considered. Returns None if the bipartition is not observed."""
+
+        k = self.count(bits)
+        if k < 1:
+            return None
+
+        others = [c for b, c in self.conflicting(bits) if c >= min_frequency * self.ntrees]
+        if len(others) < 1:
+            return 1.0
+
+        counts = [k] + others
+        total = float(sum(counts))
+        log_n = math.log(len(counts))
+        ica = 1 + sum([(c / total) * math.log(c / total) / log_n for c in counts])
+        return -ica if max(others) > k else ica
+
+def contains(a, b):
+    """Return True if the set of tips a contains every tip in b."""
+    return a & b == b
+
+def count_bits(bits):
+    """Return the number of tips in the set."""
+    return bin(bits).count('1')
@@ -12,8 +12,8 @@ if __name__ == '__main__':
     treefile = open(treefname, "r")
     tree = newick3.parse(treefile.readline())
 
-    obs_names = []
-    #tips_to_remove = []
+    obs_names = set()
+    tips_to_remove = []
     for tip in tree.leaves():
 
     #    print "checking name " + tip.label
@@ -24,7 +24,7 @@ if __name__ == '__main__':
 
         if parts[2] in ["sp", "hybrid", "aff"]:
             print "removing " + tip.label
-            tip.prune()
+            tips_to_remove.append(tip.label)
             continue
     
         elif parts[2] == "cf":
@@ -47,7 +47,7 @@ if __name__ == '__main__':
         if name_ok:
             if newname in obs_names:
                 print "removing duplicate of: " + newname
-                tip.prune()
+                tips_to_remove.append(tip.label)
 
                 # compress knuckle if there is one
     #            if len(parent.children) == 1:
@@ -66,37 +66,12 @@ if __name__ == '__main__':
             else:
                 print newname
                 tip.label = newname
-                obs_names.append(newname)
-
-    #nodes_to_remove = []
-    for n in tree.descendants():
-
-        nc = n
-        while (not nc.istip) and len(nc.children) == 0:
-            print "pruning an empty tip"
-            np = nc.parent
-            nc.prune()
-            if np:
-                nc = np
-            else:
-                break
-        
-    #    if not n.istip:
-    #        if len(n.children) == 0:
-    #            nodes_to_remove.insert(0,n)
-    #        else:
-    #            empty = True
-    #            for c in n.children:
-    #                if c not in nodes_to_remove:
-    #                    empty = False
-    #                    break
-    #        if empty:
-    #            nodes_to_remove.insert(0,n)
-
-    #print ""
-    #for dud in nodes_to_remove:
-    #    print "removing an empty tip!"
-    #    dud.parent.remove_child(dud)
+                obs_names.add(newname)
+
+    # remove the tips, and any empty clades or knuckles left behind, in one pass
+    tree = phylo3.prune_tips(tree, tips_to_remove)
+    if tree is None:
+        sys.exit("every tip of the tree in " + treefname + " was removed, leaving no tree to write")
 
     outfile = open(treefname.rsplit(".tre",1)[0] + ".renamed.tre","w")
     outfile.write(newick3.tostring(tree) + ";")
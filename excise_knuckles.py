@@ -9,13 +9,10 @@ if __name__ == '__main__':
         sys.exit(0)
 
     treefname = sys.argv[1]
-    treefile = open(treefname, "r")
 
     logfile = open("excise_knuckles.log","w")
 
-    for line in treefile:
-
-        tree = newick3.parse(line)
+    for tree in newick3.iter_trees(treefname):
 
         while len(tree.children) < 2:
             # prune knuckles at the root of the tree if necessary
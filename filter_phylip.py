@@ -5,51 +5,37 @@ _title = 'Filter a phylip alignment'
 if __name__ == "__main__":
 
     import os
+    import phylip
     import sys
 
     if len(sys.argv) < 4:
         print "usage: filter_phylip.py <infile> [excluded=<excludedtaxafile> | accepted=<acceptednamesfile>] <outfile>"
         sys.exit(0)
 
-    infile = open(sys.argv[1],"r")
-    outfile = open(sys.argv[3],"w")
+    reader = phylip.PhylipReader(sys.argv[1])
+    outfile = open(sys.argv[3],"wb")
     
     listtype, namesfile = sys.argv[2].split("=")
     
 
     if listtype == "excluded" or listtype == "accepted":
-        names = [n.strip() for n in open(namesfile,"r").readlines()]
+        names = set([n.strip() for n in open(namesfile,"r").readlines()])
     else:
         print "unrecognized type for names list; please use 'excluded' or 'accepted'"
         sys.exit(0)
 
-    while True:
-        testline = infile.readline()
-        try:
-            ntax, nsites = [int(n) for n in testline.split()]
-            break
-        except IndexError:
-            continue
-
-    saved = list()
-
-    ntax = 0
-    for name, seq in [line.split() for line in infile]:
-
-        if listtype == "excluded":
-            if name in names:
-                continue
-
-        elif listtype == "accepted":
-            if name not in names:
-                continue
-
-        saved.append(name + " " + seq + "\n")
-        ntax += 1
+    if listtype == "excluded":
+        saved = [name for name in reader.taxa if name not in names]
+    else:
+        saved = [name for name in reader.taxa if name in names]
 
-    outfile.write(str(ntax) + " " + str(nsites) + "\n")
+    outfile.write((str(len(saved)) + " " + str(reader.ncols) + "\n").encode("latin-1"))
 
-    for line in saved:
-        outfile.write(line);
+    # sequences are written straight from the memory-mapped input file
+    for name in saved:
+        outfile.write((name + " ").encode("latin-1"))
+        outfile.write(reader.view(name))
+        outfile.write(b"\n")
 
     outfile.close()
+    reader.close()
@@ -2,7 +2,7 @@
 
 if __name__ == '__main__':
 
-    import sys
+    import phylip, sys
     from copy import deepcopy
 
     if len(sys.argv) < 3:
@@ -12,24 +12,15 @@ if __name__ == '__main__':
     alnfname = sys.argv[1]
     paramfname = sys.argv[2]
 
-    alnfile = open(alnfname,"r")
+    alnreader = phylip.PhylipReader(alnfname)
+    ntaxa, nsites = alnreader.ntax, alnreader.ncols
     alignment = {}
 
     empty_partition = {}
-    first = True
-    for line in alnfile:
-        if first:
-            ntaxa, nsites = [int(n) for n in line.strip().split()]
-            first = False
-            continue
-
-        try:
-            name, seq = line.strip().split()
-        except IndexError:
-            continue
-
-        alignment[name] = seq
+    for name in alnreader.taxa:
+        alignment[name] = alnreader.get_bytes(name)
         empty_partition[name] = []
+    alnreader.close()
 
     paramfile = open(paramfname,"r")
     pfilecontents = paramfile.readlines()
@@ -1,10 +1,17 @@
 """Classes and methods for performing basic operations on Newick trees.""" 
 
-import string, sys
+import gc, io, re, sys
 from shlex import shlex
 from phylo3 import Node
 from io import StringIO
 
+# the number of characters to read at a time when parsing from a file-like object
+READ_CHUNK_SIZE = 1 << 16
+
+class NewickError(Exception):
+    """Raised when a tree description cannot be parsed"""
+    pass
+
 class Tokenizer(shlex):
     """Provides tokens for parsing Newick-format trees"""
     def __init__(self, infile):
@@ -29,11 +36,255 @@ class Tokenizer(shlex):
                 pass
         return comment[:-1] 
 
-def parse(indata, ttable=None):
+# a single token: a quoted label (with '' as an escaped quote), the start of a
+# comment, a structural character, or a run of any other non-whitespace characters
+_TOKEN_RE = re.compile(r"\s*(?:('(?:[^']|'')*')|(\[)|([(),:;])|([^\s(),:;\[\]']+))")
+_TRAILING_SPACE_RE = re.compile(r"\s*")
+
+def _find_comment_end(s, i):
+    """return the index of the ']' closing the comment whose '[' is at s[i-1]"""
+    depth = 1
+    while depth > 0:
+        j = s.find(']', i)
+        if j < 0:
+            raise NewickError("unexpected end of input mid-comment")
+        depth += s.count('[', i, j) - 1
+        i = j + 1
+    return j
+
+_DELIMITER_RE = re.compile(r"[;'\[]")
+
+def _find_tree_end(s, i=0):
+    """
+    Find the ';' that terminates the tree description in s, ignoring any inside
+    quoted labels or comments. Returns the index of the ';' (or -1 if it is not
+    in s), and a position from which a search may be resumed once more data
+    has been appended to s.
+    """
+
+    search = _DELIMITER_RE.search
+    while True:
+        m = search(s, i)
+        if m is None:
+            return -1, len(s)
+        j = m.start()
+        c = s[j]
+        if c == ';':
+            return j, j
+        elif c == "'":
+            # an escaped quote ('') just closes and reopens the label
+            k = s.find("'", j + 1)
+        else:
+            try:
+                k = _find_comment_end(s, j + 1)
+            except NewickError:
+                k = -1
+        if k < 0:
+            return -1, j
+        i = k + 1
+
+def _scan(s, ttable=None):
+    """
+    Scan the first tree description in the string s in a single pass. Returns
+    the root node, the position just past the end of the tree description, and
+    a boolean indicating whether the description was terminated by a ';' (as
+    opposed to the end of the string).
+    """
+
+    fields, i, terminated = _scan_fields(s, ttable)
+    root = _nodes_from_fields(*fields) if fields[0] else None
+    return root, i, terminated
+
+def _nodes_from_fields(parents, labels, lengths, istips, comments):
+    """Build phylo3.Node objects from the preorder node fields produced by _scan_fields."""
+
+    # every node is part of a parent/child reference cycle, so the cyclic garbage
+    # collector would otherwise walk the growing tree over and over while we build it
+    gc_was_enabled = gc.isenabled()
+    gc.disable()
+    try:
+        nodes = []
+        for p, label, length, istip in zip(parents, labels, lengths, istips):
+            node = Node()
+            node._label = label
+            node.length = length
+            node.istip = istip
+            if p >= 0:
+                # link directly; add_child's membership check is redundant
+                # for new nodes and makes wide polytomies quadratic
+                parent = nodes[p]
+                parent.children.append(node)
+                parent.nchildren += 1
+                node.parent = parent
+            nodes.append(node)
+        for k, comment in comments.items():
+            nodes[k].comment = comment
+    finally:
+        if gc_was_enabled:
+            gc.enable()
+
+    return nodes[0]
+
+def _scan_fields(s, ttable):
+    """
+    Scan the first tree description in the string s without creating any node
+    objects. Returns a tuple of per-node fields (parent indices, labels, branch
+    lengths, tip flags and a dict of comments by node index), with the nodes in
+    preorder and the root at index 0, followed by the position just past the
+    end of the tree description and whether it was terminated by a ';'.
+    """
+
+    match = _TOKEN_RE.match
+    parents = []; labels = []; lengths = []; istips = []; comments = {}
+    add_parent = parents.append; add_label = labels.append
+    add_length = lengths.append; add_istip = istips.append
+    node = -1
+    lp = 0; rp = 0
+    after_close = False
+    terminated = False
+
+    i = 0
+    n = len(s)
+    while i < n:
+        m = match(s, i)
+        if m is None:
+            if _TRAILING_SPACE_RE.match(s, i).end() == n:
+                i = n
+                break
+            raise NewickError("unexpected character '%s' at position %d" % (s[i], i))
+        i = m.end()
+        quoted, comment, punct, word = m.groups()
+
+        if punct is not None:
+            if punct == ';':
+                terminated = True
+                break
+
+            # internal node
+            elif punct == '(':
+                lp += 1
+                add_parent(node)
+                node = len(labels)
+                add_label(None)
+                add_length(0)
+                add_istip(False)
+                after_close = False
+                continue
+
+            elif punct == ')':
+                rp += 1
+                if node < 0 or parents[node] < 0:
+                    raise NewickError("unbalanced parentheses at position %d" % (i - 1))
+                node = parents[node]
+                after_close = True
+                continue
+
+            elif punct == ',':
+                if node < 0 or parents[node] < 0:
+                    raise NewickError("unexpected ',' outside of parentheses at position %d" % (i - 1))
+                node = parents[node]
+
+            # branch length
+            else:
+                if node < 0:
+                    raise NewickError("unexpected ':' at position %d" % (i - 1))
+                m = match(s, i)
+                if m is None or m.group(4) is None:
+                    raise NewickError("unexpected end-of-file (expecting branch length)")
+                i = m.end()
+                try:
+                    lengths[node] = float(m.group(4))
+                except ValueError:
+                    raise NewickError("invalid literal for branch length, '%s'" % m.group(4))
+
+        # comment
+        elif comment is not None:
+            j = _find_comment_end(s, i)
+            if node >= 0: # ignore comments preceding the tree, e.g. [&R]
+                comments[node] = s[i:j].strip()
+            i = j + 1
+
+        # leaf node or internal node label
+        else:
+            token = quoted if quoted is not None else word
+            if not after_close: # leaf node
+                if ttable:
+                    ttoken = ttable.get(token) or ttable.get(int(token))
+                    if ttoken:
+                        token = ttoken
+                add_parent(node)
+                node = len(labels)
+                add_label(token)
+                add_length(0)
+                add_istip(True)
+            else: # label
+                labels[node] = token
+
+        after_close = False
+
+    assert lp == rp, \
+           'unbalanced parentheses in tree description'
+
+    return (parents, labels, lengths, istips, comments), i, terminated
+
+def parse(indata, ttable=None, use_shlex=False):
+    """
+    Parse a Newick-formatted tree description. input is a string or a file-like
+    object; if a file-like object is given then only the first tree is parsed,
+    and the position in the file is restored afterward if possible.
+
+    Tokens are read in a single pass with a compiled regular expression. The
+    older shlex-based tokenizer may be used instead by setting use_shlex=True.
+    """
+
+    if use_shlex:
+        return parse_shlex(indata, ttable)
+
+    if isinstance(indata, str):
+        return _scan(indata, ttable)[0]
+
+    return _scan(_read_first_tree(indata), ttable)[0]
+
+def parse_arrays(indata, ttable=None):
     """
-    Parse a Newick-formatted tree description
+    Parse a Newick-formatted tree description directly into a compact
+    phyarray.ArrayTree, without creating any phylo3.Node objects. Arguments are
+    as for parse(). Requires numpy.
+    """
+
+    from phyarray import ArrayTree
+
+    if not isinstance(indata, str):
+        indata = _read_first_tree(indata)
+
+    (parents, labels, lengths, istips, comments), i, terminated = _scan_fields(indata, ttable)
+    if len(parents) < 1:
+        return None
+    return ArrayTree(parents, lengths, labels, istips, comments)
+
+def _read_first_tree(indata):
+    """
+    Read from the file-like object indata up to the ';' that ends the first tree
+    description, and return the text read. The position in the file is restored
+    afterward if possible.
+    """
+
+    start_pos = indata.tell() if indata.seekable() else None
+
+    # read until we have seen the ';' that ends the first tree
+    desc = next(_split_trees(indata), '')
+
+    if start_pos is not None:
+        indata.seek(start_pos)
+
+    return desc
+
+def parse_shlex(indata, ttable=None):
+    """
+    Parse a Newick-formatted tree description using the shlex tokenizer.
     input is any file-like object that can be coerced into shlex,
-    or a string (converted to StringIO)
+    or a string (converted to StringIO). This is much slower than the
+    default scanner used by parse(), and is kept as a fallback.
     """
     
 #    print(indata)
@@ -79,9 +330,9 @@ def parse(indata, ttable=None):
                 try:
                     brlen = float(token)
                 except ValueError:
-                    raise "NewickError invalid literal for branch length, '%s'" % token
+                    raise NewickError("invalid literal for branch length, '%s'" % token)
             else:
-                raise "NewickError unexpected end-of-file (expecting branch length)"
+                raise NewickError("unexpected end-of-file (expecting branch length)")
 
             node.length = brlen
         # comment
@@ -124,41 +375,209 @@ def traverse(node):
     if node.istip: return node.back
     else: return node.next.back
         
-def to_string(node, length_fmt=":%s", use_node_labels=True, use_branch_lengths=True):
+# the number of pieces of output to collect before writing them to the file in one call
+WRITE_BUFFER_SIZE = 1 << 12
 
-    if node.istip:
-        node_str = "%s" % node.label
+def figtree_color_comment(node):
+    """A comment_function for write() that produces FigTree color annotations from the
+    color_string attribute of each node (a hex RGB value, e.g. 'ff0000')"""
+    return "&!color=#" + node.color_string
 
-    else:
-        node_label = ''
-        if use_node_labels and node.label != None:
-            node_label = node.label
+def write(node, outfile, length_fmt=":%s", use_node_labels=True, use_branch_lengths=True, \
+          label_function=None, length_function=None, comment_function=None):
+    """
+    Write the Newick description of the subtree below node to a file-like object (not
+    including the terminal ';'). The tree is traversed with an explicit stack, and output is
+    written in large chunks, so very deep or very large trees may be written efficiently.
 
-        node_str = "(%s)%s" % \
-                   (','.join([ to_string(child, length_fmt, use_node_labels, use_branch_lengths) \
-                               for child in node.children ]), node_label)
+    The text written for each node may be customized by passing functions that accept a node
+    and return a string: label_function for the label, length_function for the branch length
+    (including the ':'), and comment_function for the contents of a [...] comment written
+    after the label. If comment_function returns None then no comment is written.
+    """
 
-    if use_branch_lengths and node.length is not None and node.length != '':
-        length_str = length_fmt % node.length
-    else:
-        length_str = ''
-    
-    node_str = "%s%s" % (node_str, length_str)
+    parts = []
+    append = parts.append
+    stack = [(node, False)]
+    pop = stack.pop
+    push = stack.append
+    while len(stack) > 0:
+        n, closing = pop()
+
+        # a separator between siblings
+        if n is None:
+            append(',')
+            continue
+
+        # open an internal node, and push its children to be written before it is closed
+        if not closing and not n.istip:
+            append('(')
+            push((n, True))
+            children = n.children
+            for i in range(len(children) - 1, 0, -1):
+                push((children[i], False))
+                push((None, False))
+            if len(children) > 0:
+                push((children[0], False))
+            continue
+
+        # close an internal node, or write a tip
+        if closing:
+            append(')')
 
-    return node_str
+        if label_function is not None:
+            append(label_function(n))
+        elif closing:
+            if use_node_labels and n.label is not None:
+                append("%s" % n.label)
+        else:
+            append("%s" % n.label)
+
+        if comment_function is not None:
+            comment = comment_function(n)
+            if comment is not None:
+                append('[' + comment + ']')
+
+        if length_function is not None:
+            append(length_function(n))
+        elif use_branch_lengths and n.length is not None and n.length != '':
+            append(length_fmt % n.length)
+
+        if len(parts) > WRITE_BUFFER_SIZE:
+            outfile.write(''.join(parts))
+            parts = []
+            append = parts.append
+
+    outfile.write(''.join(parts))
+
+def to_string(node, length_fmt=":%s", use_node_labels=True, use_branch_lengths=True, \
+              label_function=None, length_function=None, comment_function=None):
+    """Return the Newick description of the subtree below node. See write() for the arguments."""
+    s = StringIO()
+    write(node, s, length_fmt, use_node_labels, use_branch_lengths, \
+          label_function, length_function, comment_function)
+    return s.getvalue()
 
 tostring = to_string
         
-def parse_from_file(filename):
-    if filename == '-':
-        file = sys.stdin
+def _split_trees(infile):
+    """
+    Generate the tree descriptions (each including its terminating ';') in a
+    file-like object one at a time. Only one tree and one chunk of input are
+    held in memory at once.
+    """
+
+    # the text of the current tree description is collected from each chunk as it is searched,
+    # and joined once its end is found, so a large tree is copied a fixed number of times
+    parts = []
+    buf = ''
+    start = 0  # the start of the rest of the current tree description in buf
+    resume = 0 # the position from which to continue searching for its end
+    while True:
+        end, resume = _find_tree_end(buf, resume)
+        if end >= 0:
+            parts.append(buf[start:end+1])
+            yield ''.join(parts)
+            parts = []
+            start = resume = end + 1
+            continue
+
+        # only an unclosed quoted label or comment (from resume on) is carried over
+        parts.append(buf[start:resume])
+        chunk = infile.read(READ_CHUNK_SIZE)
+        if len(chunk) == 0:
+            break
+        buf = buf[resume:] + chunk
+        start = resume = 0
+
+    # allow the last tree in the file to be missing its ';'
+    rest = ''.join(parts) + buf[resume:]
+    if len(rest.strip()) > 0:
+        yield rest
+
+def _is_blank(desc):
+    """return True if a tree description contains only whitespace and comments"""
+    i = 0
+    while True:
+        m = _TOKEN_RE.match(desc, i)
+        if m is None:
+            return True
+        elif m.group(2) is None:
+            return m.group(3) == ';'
+        i = _find_comment_end(desc, m.end()) + 1
+
+def index_trees(filename):
+    """
+    Return a list of the byte offsets at which each tree description in the
+    file begins, for use with iter_trees(start=..., index=...).
+    """
+
+    offsets = []
+    with open(filename, 'rb') as infile:
+        # latin-1 maps bytes one-to-one onto characters, so string positions are
+        # byte offsets. the delimiters are ascii, which never occurs inside a
+        # multibyte utf-8 character, so this is safe for utf-8 files too
+        pos = 0
+        for desc in _split_trees(_Latin1Reader(infile)):
+            if not _is_blank(desc):
+                offsets.append(pos)
+            pos += len(desc)
+    return offsets
+
+class _Latin1Reader():
+    """Present a binary file as a text file, decoding one byte per character"""
+
+    def __init__(self, infile):
+        self.infile = infile
+
+    def read(self, size):
+        return self.infile.read(size).decode('latin-1')
+
+def iter_trees(indata, ttable=None, start=0, index=None):
+    """
+    Generate the trees in indata one at a time. indata is a filename, '-' for
+    stdin, or a file-like object. Trees are separated by ';' rather than by
+    newlines, and memory use is bounded by the size of the largest tree.
+
+    If start is given then the first start trees are skipped without being
+    parsed. If an index from index_trees() is also given (indata must then be
+    a filename), the file is seeked directly to the start-th tree.
+    """
+
+    if indata == '-':
+        infile = sys.stdin
+    elif isinstance(indata, str):
+        if index is not None:
+            if start >= len(index):
+                return
+            binfile = open(indata, 'rb')
+            binfile.seek(index[start])
+            infile = io.TextIOWrapper(binfile)
+            start = 0
+        else:
+            infile = open(indata, 'r')
     else:
-        file = open(filename, 'r')
-    content = string.strip(file.read())
-    treedescs = string.split(content, ';')
-    tree = parse(treedescs[0])
-    file.close()
-    return tree
+        if index is not None:
+            raise ValueError("a tree index can only be used when reading from a named file")
+        infile = indata
+
+    try:
+        i = 0
+        for desc in _split_trees(infile):
+            if _is_blank(desc):
+                continue
+            if i >= start:
+                yield _scan(desc, ttable)[0]
+            i += 1
+    finally:
+        if infile is not indata and infile is not sys.stdin:
+            infile.close()
+
+def parse_from_file(filename):
+    """Return the first tree in the file (or stdin, if filename is '-')"""
+    for tree in iter_trees(filename):
+        return tree
+    return None
 
 if __name__ == "__main__":
     #import ascii
@@ -45,23 +45,12 @@ def make_newick_with_color_strings(node):
     '''Return a newick string encoding the subtree below the passed node, with FigTree-format color
     labels defined by the color_string property on the subtree's nodes.'''
 
-    if not node.istip:
-
-        substrings = []
-        for child in node.children:
-            substrings.append(make_newick_with_color_strings(child))
-
-        return "(" + ",".join(substrings) + ")[&!color=#" + node.color_string + "]:" + str(node.length)
-
-    else:
-
-        return node.label + "[&!color=#" + node.color_string + "]:" + str(node.length)
+    return newick3.to_string(node, use_node_labels=False, comment_function=newick3.figtree_color_comment)
 
 def write_tree(outfile_name, tree):
 
-    '''Write the tree, painted by the color bins, in the figtree format, to the specified outfile. Calls
-    make_newick_with_color_strings, which assumes that the tree nodes contain color_string attributes
-    that will be populated into the output.'''
+    '''Write the tree, painted by the color bins, in the figtree format, to the specified outfile. Assumes
+    that the tree nodes contain color_string attributes that will be populated into the output.'''
 
     outfile = open(outfile_name,"w")
     outfile.write("#NEXUS\nbegin taxa\n\tdimensions ntax=" + str(len(tree.leaves())) + ";\n\ttaxlabels\n")
@@ -69,7 +58,7 @@ def write_tree(outfile_name, tree):
         outfile.write("\t"+tip.label+"\n")
     outfile.write(";\nend;\n\nbegin trees;\n\ttree tree1 = [&R]\t")
 
-    outfile.write(make_newick_with_color_strings(tree))
+    newick3.write(tree, outfile, use_node_labels=False, comment_function=newick3.figtree_color_comment)
 
     outfile.write(";\nend;\n\n")
     outfile.write(figtree_blocks.circular_sorted_tree)
@@ -30,34 +30,44 @@ class Alignment():
         
     def _parse_alignment(self, alignment_file):
     
-        import os
-    
-        self.base_name = os.path.basename(alignment_file.name).rsplit('.phy',1)[0]
-    
-        ntax = 0
-        self.ncols = 0
-        self._taxa = []
-        on_first_line = True
-        for line in alignment_file:
-            toks = [l.strip() for l in line.split()]
-            if len(toks) > 1:
-                if on_first_line == True:
-                    on_first_line = False
-                    ntax = int(toks[0])
-                    self.ncols = int(toks[1])
-                    if len(self.partitions()) < 1:
-                        p = Partition(alignment = self, name = 'all', type = 'DNA', start = 1, end = int(self.ncols))
-                        self._parts_by_name[p.name] = p
-                else:
-                    name = toks[0]
-                    seq = toks[1]
-                    self._taxa.append(name)
-                    for p in self.partitions():
-                        p.set_seq_for_taxon(name, seq[p.start-1:p.end])
-            else:
-                raise IndexError("too many items on line '" + line + "' in alignment") 
+        import os, phylip
+        import numpy as np
     
-        assert(ntax == len(self._taxa))
+        # a file is read through a memory map, and each sequence is copied straight from the
+        # mapped file into its row of the matrix. streams without a file (such as stdin or a
+        # StringIO) are read into memory instead
+        path = getattr(alignment_file, 'name', None)
+        if isinstance(path, str) and os.path.isfile(path):
+            self.base_name = os.path.basename(path).rsplit('.phy',1)[0]
+            reader = phylip.PhylipReader(path)
+        else:
+            self.base_name = 'alignment'
+            data = alignment_file.read()
+            reader = phylip.PhylipReader(str(path) if path is not None else '<stream>', \
+                                         data=data.encode('latin-1') if isinstance(data, str) else data)
+
+        with reader:
+            self.ncols = reader.ncols
+            self._taxa = list(reader.taxa)
+            self._taxon_rows = dict((t, i) for i, t in enumerate(self._taxa))
+            self.matrix = np.empty((len(self._taxa), self.ncols), dtype=np.uint8)
+            for i, t in enumerate(self._taxa):
+                self.matrix[i] = np.frombuffer(reader.view(t), dtype=np.uint8)
+
+        if len(self.partitions()) < 1:
+            p = Partition(alignment = self, name = 'all', type = 'DNA', start = 1, end = int(self.ncols))
+            self._parts_by_name[p.name] = p
+
+    def row_for_taxon(self, t):
+        """Return the index of the row of the character matrix that holds the sequence for t."""
+        return self._taxon_rows[t]
+
+    def get_row_for_taxon(self, t):
+        """Return the full sequence for t, as a view of one row of the uint8 character matrix."""
+        return self.matrix[self._taxon_rows[t]]
+
+    def get_seq_for_taxon(self, t):
+        return self.get_row_for_taxon(t).tobytes().decode('latin-1')
     
     def partitions(self): # should return an iterator over the partitions in this alignment
         return self._parts_by_name.values()
@@ -65,8 +75,9 @@ class Alignment():
     def get_partition(self, p):
         return self._parts_by_name[p]
     
-    def random_part(self): # should return a partition object
-        return list(self._parts_by_name.keys())[random.randrange(len(self._parts_by_name))]
+    def random_part(self):
+        import random
+        return self._parts_by_name[random.choice(list(self._parts_by_name.keys()))]
 
     def ntaxa(self):
         return len(self._taxa)
@@ -81,6 +92,8 @@ class Alignment():
         return self._parts_by_name.keys()
 
 class Partition():
+    """A named range of columns in an alignment. Sequences are not copied; they are read as views
+    of the alignment's character matrix, so partitions cost no memory beyond their bounds."""
 
     def __init__(self, alignment = None, name = '', type = '', start = 0, end = 0):
         self.alignment = alignment
@@ -88,139 +101,310 @@ class Partition():
         self.type = type
         self.start = start
         self.end = end
-        self._seqs_by_taxa = {}
+
+    @property
+    def ncols(self):
+        return self.end - self.start + 1
+
+    @property
+    def matrix(self):
+        """the ntaxa x ncols block of the alignment's uint8 character matrix for this partition,
+        as a view (not a copy), with rows in the same order as the alignment's taxon labels"""
+        return self.alignment.matrix[:, self.start-1:self.end]
 
     def set_seq_for_taxon(self, t, seq):
-        self._seqs_by_taxa[t] = seq
+        import numpy as np
+        if len(seq) != self.ncols:
+            raise ValueError("sequence for '" + t + "' does not match the length of partition " + self.name)
+        self.matrix[self.alignment.row_for_taxon(t)] = np.frombuffer(seq.encode('latin-1'), dtype=np.uint8)
+
+    def get_row_for_taxon(self, t):
+        """Return the sequence for t in this partition as a view of the character matrix."""
+        return self.alignment.matrix[self.alignment.row_for_taxon(t), self.start-1:self.end]
     
     def get_seq_for_taxon(self, t):
-        return self._seqs_by_taxa[t]
+        return self.get_row_for_taxon(t).tobytes().decode('latin-1')
+
+    def missing_counts(self, missing=None):
+        """Return an array of the number of missing characters (gaps and ambiguous or unknown
+        states, see MISSING_CHARACTERS) in this partition for each taxon, in alignment order."""
+        return count_characters(self.matrix, MISSING_CHARACTERS if missing is None else missing)
+
+    def empty_taxa(self, missing=None):
+        """Return a list of the labels of the taxa that have only missing data in this partition."""
+        import numpy as np
+        taxa = self.alignment.taxon_labels()
+        return [taxa[i] for i in np.flatnonzero(self.missing_counts(missing) == self.ncols)]
+
+    def is_empty_for_taxon(self, t, missing=None):
+        """Return True if the sequence for t has only missing data in this partition."""
+        row = self.get_row_for_taxon(t)
+        return count_characters(row.reshape(1, -1), MISSING_CHARACTERS if missing is None else missing)[0] == len(row)
+
+# characters treated as missing data by default: gaps, unknown states and ambiguous nucleotides
+MISSING_CHARACTERS = '-?Nn'
+
+# the number of matrix cells to examine at a time in count_characters and to assemble at a time
+# in _Subsampler.write_subsampled_output and write_columns, to bound temporary memory
+COUNT_BLOCK_SIZE = 1 << 24
+WRITE_BLOCK_SIZE = 1 << 24
+
+def count_characters(matrix, characters):
+    """Return an array with the number of cells in each row of the uint8 character matrix that
+    hold any of the given characters. Rows are processed in blocks, so the temporary arrays stay
+    small even when the matrix is very large."""
+
+    import numpy as np
+
+    lookup = np.zeros(256, dtype=bool)
+    lookup[np.frombuffer(characters.encode('latin-1'), dtype=np.uint8)] = True
+
+    counts = np.zeros(matrix.shape[0], dtype=np.int64)
+    rows_per_block = max(1, COUNT_BLOCK_SIZE // max(1, matrix.shape[1]))
+    for i in range(0, matrix.shape[0], rows_per_block):
+        counts[i:i+rows_per_block] = np.count_nonzero(lookup[matrix[i:i+rows_per_block]], axis=1)
+    return counts
 
 class _Subsampler():
 
     DEFAULT_LABEL = 'subsampled'
 
-    def __init__(self, alignment):
-        import random
+    def __init__(self, alignment, seed=None):
+        import numpy as np
         self.alignment = alignment
+        self.rng = np.random.default_rng(seed)
         self._init_subsample()
     
     def _init_subsample(self):
 
-        self._sample_bitmap = {}
-        self._num_taxa_sampled_by_part = {}
-        self._num_parts_sampled_by_taxon = {}
+        import numpy as np
+
+        # the sampling state is a boolean matrix with a row for each taxon (in alignment order)
+        # and a column for each partition. all counts are reductions over it
+        self._taxa = list(self.alignment.taxon_labels())
+        self._taxon_ordinals = dict((t, i) for i, t in enumerate(self._taxa))
+        self._parts = list(self.alignment.partition_labels())
+        self._part_ordinals = dict((p, j) for j, p in enumerate(self._parts))
+        self._sample_bitmap = np.zeros((len(self._taxa), len(self._parts)), dtype=bool)
+
+    @property
+    def sample_bitmap(self):
+        """the ntaxa x nparts boolean sampling matrix, with rows in the order of the alignment's
+        taxon labels and columns in the order of its partition labels"""
+        return self._sample_bitmap
+
+    @property
+    def k(self):
+        """the number of sampled (taxon, partition) cells"""
+        import numpy as np
+        return int(np.count_nonzero(self._sample_bitmap))
 
-        # iterate over taxa first since they are the level 0 keys in the sample bitmap
-        for t in self.alignment.taxon_labels():
-            self._num_parts_sampled_by_taxon[t] = 0
-            self._sample_bitmap[t] = {}
-
-        # then add the partitions
-        for p in self.alignment.partition_labels():
-            self._num_taxa_sampled_by_part[p] = 0
-            for t in self.alignment.taxon_labels():
-                self._sample_bitmap[t][p] = False
-        
-        self.k = 0
-    
     def get_sampling_proportion(self):
         return float(self.k) / (self.alignment.nparts() * self.alignment.ntaxa())
-    
-    def _validate(self, t, p):
-#        print t
-        assert t in self._sample_bitmap
-        assert p in self._sample_bitmap[t]
-        assert t in self._num_parts_sampled_by_taxon
-        assert p in self._num_taxa_sampled_by_part
+
+    def _cell(self, t, p):
+        """return the (row, column) of taxon t and partition p in the sample bitmap. unknown
+        labels raise a KeyError"""
+        return self._taxon_ordinals[t], self._part_ordinals[p]
     
     def set_random_seed(self, s):
+        import random
+        import numpy as np
         random.seed(s)
+        self.rng = np.random.default_rng(s)
 
     def sample(self, t, p):
-        self._validate(t, p)
-        self._sample_bitmap[t][p] = True
-        self._num_taxa_sampled_by_part[p] += 1
-        self._num_parts_sampled_by_taxon[t] += 1
-        self.k += 1
+        self._sample_bitmap[self._cell(t, p)] = True
     
     def unsample(self, t, p):
-        self._validate(t,p)
-        self._sample_bitmap[t][p] = False
-        self._num_taxa_sampled_by_part[p] -= 1
-        self._num_parts_sampled_by_taxon[t] -= 1
-        self.k -= 1
+        self._sample_bitmap[self._cell(t, p)] = False
     
     def is_sampled(self, t, p):
-        self._validate(t,p)
-        return self._sample_bitmap[t][p]
+        return bool(self._sample_bitmap[self._cell(t, p)])
+
+    def sample_mask(self, mask):
+        """Mark every cell that is True in the boolean ntaxa x nparts mask as sampled."""
+        self._sample_bitmap |= mask
+
+    def unsample_mask(self, mask):
+        """Mark every cell that is True in the boolean ntaxa x nparts mask as not sampled."""
+        self._sample_bitmap &= ~mask
     
     def partitions_sampled_for_taxon(self, t):
-        for p in self.alignment.partition_labels():
-            if self.is_sampled(t, p):
-                yield self.alignment.get_partition(p)
+        import numpy as np
+        for j in np.flatnonzero(self._sample_bitmap[self._taxon_ordinals[t]]):
+            yield self.alignment.get_partition(self._parts[j])
     
     def number_parts_sampled_for(self, t):
-        return self._num_parts_sampled_by_taxon[t]
+        import numpy as np
+        return int(np.count_nonzero(self._sample_bitmap[self._taxon_ordinals[t]]))
     
     def number_taxa_sampled_for(self, p):
-        return self._num_taxa_sampled_by_part[p]
+        import numpy as np
+        return int(np.count_nonzero(self._sample_bitmap[:, self._part_ordinals[p]]))
+
+    def parts_sampled_per_taxon(self):
+        """Return an array of the number of partitions sampled for each taxon, in alignment order."""
+        import numpy as np
+        return np.count_nonzero(self._sample_bitmap, axis=1)
+
+    def taxa_sampled_per_part(self):
+        """Return an array of the number of taxa sampled for each partition, in alignment order."""
+        import numpy as np
+        return np.count_nonzero(self._sample_bitmap, axis=0)
     
-    # iterators over the dicts to return data sorted by sampling proportion
+    # labels sorted by decreasing number of sampled cells. ties keep the alignment order
     def taxon_labels_sorted(self):
-        import functools
-        return sorted(self.alignment.taxon_labels(), \
-            key = functools.cmp_to_key(lambda p, q: (self._num_parts_sampled_by_taxon[p] > self._num_parts_sampled_by_taxon[q]) - \
-                                                    (self._num_parts_sampled_by_taxon[p] < self._num_parts_sampled_by_taxon[q])), reverse=True)
+        import numpy as np
+        return [self._taxa[i] for i in np.argsort(-self.parts_sampled_per_taxon(), kind='stable')]
 
     def partition_labels_sorted(self):
-        import functools
-        return sorted(self.alignment.partition_labels(), 
-            key = functools.cmp_to_key(lambda p, q: (self._num_taxa_sampled_by_part[p] > self._num_taxa_sampled_by_part[q]) - \
-                                                    (self._num_taxa_sampled_by_part[p] < self._num_taxa_sampled_by_part[q])), reverse=True)
+        import numpy as np
+        return [self._parts[j] for j in np.argsort(-self.taxa_sampled_per_part(), kind='stable')]
 
     def write_subsampled_output(self, label=''):
+        """Write the partitions file, the sampling matrix and the subsampled alignment, with taxa
+        and partitions in decreasing order of sampling. The three files are written together in
+        one pass over blocks of taxa. For each block, the sampled columns are gathered from the
+        alignment matrix in output order and unsampled cells are filled with gaps in bulk, so
+        each output row is written with a single call."""
+
+        import numpy as np
+
         self.output_label = self.alignment.base_name + '.' + \
             (self.DEFAULT_LABEL + '.' + label if len(label) > 0 else self.DEFAULT_LABEL)
-        
-        # first calculate new positions for partitions
-        new_start = {}
-        new_end = {}
-        last_pos = 0
-        for p in self.partition_labels_sorted():
-            pp = self.alignment.get_partition(p)
-            new_start[p] = last_pos + 1
-            last_pos = last_pos + pp.end - pp.start + 1
-            new_end[p] = last_pos
-        
-        with open(self.output_label + '.partitions.txt', 'w') as q:
-            for p in self.partition_labels_sorted():
-                q.write('DNA, ' + p + ' = ' + str(new_start[p]) + '-' + str(new_end[p]) + '\n')
-        
-        with open(self.output_label + '.sampling_matrix.tsv', 'w') as s:
-            s.write('\t'+'\t'.join(self.partition_labels_sorted())+'\n')
-            for t in self.taxon_labels_sorted():
-                s.write(t)
-                for p in self.partition_labels_sorted():
-                    s.write('\t' + ('1' if self.is_sampled(t,p) else '0'))
-                s.write('\n')
-
-        with open(self.output_label + '.phy', 'w') as a:
-            a.write('{0} {1}\n'.format(self.alignment.ntaxa(), self.alignment.ncols))
-            for t in self.taxon_labels_sorted():
-                a.write(t + ' ')
-                for p in self.partition_labels_sorted():
-                    pp = self.alignment.get_partition(p)
-                    if self.is_sampled(t,p):
-                        a.write(pp.get_seq_for_taxon(t))
-                    else:
-                        a.write('-' * (pp.end - pp.start + 1))
-                a.write('\n')
+
+        # the sort orders are calculated once
+        part_order = np.argsort(-self.taxa_sampled_per_part(), kind='stable')
+        taxon_order = np.argsort(-self.parts_sampled_per_taxon(), kind='stable')
+        parts = [self.alignment.get_partition(self._parts[j]) for j in part_order]
+
+        # the alignment columns in output order, and the bitmap column each one is sampled by
+        columns = np.concatenate([np.arange(pp.start - 1, pp.end) for pp in parts]) \
+                  if len(parts) > 0 else np.zeros(0, dtype=np.intp)
+        column_parts = np.repeat(part_order, [pp.ncols for pp in parts])
+
+        # sampling matrix rows are tab-separated 0/1 flags; the flags go in the odd positions
+        flags = np.full(2 * len(parts) + 1, ord('\t'), dtype=np.uint8)
+        flags[-1] = ord('\n')
+
+        gap = np.uint8(ord('-'))
+        rows_per_block = max(1, WRITE_BLOCK_SIZE // max(1, len(columns)))
+
+        with open(self.output_label + '.partitions.txt', 'w') as q, \
+             open(self.output_label + '.sampling_matrix.tsv', 'wb') as m, \
+             open(self.output_label + '.phy', 'wb') as a:
+
+            last_pos = 0
+            for pp in parts:
+                q.write('DNA, ' + pp.name + ' = ' + str(last_pos + 1) + '-' + str(last_pos + pp.ncols) + '\n')
+                last_pos += pp.ncols
+
+            m.write(('\t' + '\t'.join([pp.name for pp in parts]) + '\n').encode('latin-1'))
+            a.write('{0} {1}\n'.format(self.alignment.ntaxa(), self.alignment.ncols).encode('latin-1'))
+
+            for i in range(0, len(taxon_order), rows_per_block):
+                rows = taxon_order[i:i+rows_per_block]
+                sampled = self._sample_bitmap[rows]
+                block = self.alignment.matrix[rows][:, columns]
+                block[~sampled[:, column_parts]] = gap
+                sampled_flags = np.where(sampled[:, part_order], ord('1'), ord('0')).astype(np.uint8)
+
+                for r, t in enumerate(rows):
+                    name = self._taxa[t].encode('latin-1')
+                    flags[1::2] = sampled_flags[r]
+                    m.write(name)
+                    m.write(flags.tobytes())
+                    a.write(name + b' ')
+                    a.write(block[r].tobytes())
+                    a.write(b'\n')
+
+    def seed_replicate(self, seed, replicate):
+        """Seed both the numpy Generator and the random module for one replicate of a batch. The
+        seed for each replicate depends only on the batch seed and the replicate number, so any
+        replicate can be reproduced on its own, regardless of the batch it was part of."""
+        import random
+        import numpy as np
+        seq = np.random.SeedSequence(seed, spawn_key=(replicate,))
+        self.rng = np.random.default_rng(seq)
+        random.seed(int(seq.generate_state(1, np.uint64)[0]))
+
+    def write_replicates(self, n, label='', seed=None, processes=None, start=1, method='subsample', args=()):
+        """Generate and write n replicate subsamples, numbered from start, by calling the named
+        subsampling method with args for each, and then write_subsampled_output. Replicate i
+        is seeded with seed_replicate(seed, i) and labelled label.i (or just i). If seed is None a
+        random one is chosen, which is returned so that the batch can be reproduced.
+
+        Replicates are run in a pool of processes (by default one per cpu). Where processes can be
+        forked, the workers inherit this subsampler and its alignment without copying them, since
+        the alignment is only read. Returns the seed and a list of (output label, sampling
+        proportion) tuples for the replicates, in order."""
+
+        import numpy as np
+
+        if seed is None:
+            seed = np.random.SeedSequence().entropy
+        jobs = [(i, (label + '.' if len(label) > 0 else '') + str(i), seed) for i in range(start, start + n)]
+        return seed, _map_replicates((self, method, args), _run_replicate, jobs, processes)
+
+# the object (and its settings) used by the replicates run in each worker process of
+# _Subsampler.write_replicates and Bootstrapper.write_replicates
+_replicate_worker = None
+
+def _init_replicate_worker(worker):
+    global _replicate_worker
+    _replicate_worker = worker
+
+def _map_replicates(worker, run, jobs, processes):
+    """Return [run(job) for job in jobs], with _replicate_worker set to worker, calculated in a
+    pool of processes (by default one per cpu), or in this process if processes is 1."""
+
+    import multiprocessing
+
+    if processes == 1:
+        _init_replicate_worker(worker)
+        return [run(job) for job in jobs]
+
+    if 'fork' in multiprocessing.get_all_start_methods():
+        context = multiprocessing.get_context('fork')
+    else:
+        context = multiprocessing.get_context()
+
+    pool = context.Pool(processes, initializer=_init_replicate_worker, initargs=(worker,))
+    try:
+        return pool.map(run, jobs, chunksize=1)
+    finally:
+        pool.close()
+        pool.join()
+
+def _run_replicate(job):
+    replicate, label, seed = job
+    subsampler, method, args = _replicate_worker
+    subsampler.seed_replicate(seed, replicate)
+    getattr(subsampler, method)(*args)
+    subsampler.write_subsampled_output(label)
+    return subsampler.output_label, subsampler.get_sampling_proportion()
+
+def write_replicates_and_exit(subsampler, n, label='', seed=None, processes=None, start=1, method='subsample', args=()):
+    """Write a batch of replicates with subsampler.write_replicates, print the output label and
+    sampling proportion of each and the seed for the batch, and exit. Used by the
+    subsample_alignment_* scripts when more than one replicate is requested."""
+
+    import sys
+    seed, results = subsampler.write_replicates(n, label, seed, processes, start, method, args)
+    for output_label, proportion in results:
+        print(output_label + '\tsampling proportion ' + str(proportion))
+    print('wrote ' + str(len(results)) + ' replicates with random seed ' + str(seed))
+    sys.exit()
 
 class SimpleSubsampler(_Subsampler):
+    """Samples each (taxon, partition) cell independently. subsample() calls a python function
+    once per cell; subsample_probabilities() draws the whole sampling matrix at once from the
+    subsampler's numpy Generator (self.rng), using per-taxon and per-partition probabilities or a
+    full matrix of them. Either way, every taxon is left with at least one sampled partition."""
 
-    def __init__(self, alignment):
-        _Subsampler.__init__(self, alignment)
+    def __init__(self, alignment, seed=None):
+        _Subsampler.__init__(self, alignment, seed)
     
     def subsample(self, probability_function):
         self._init_subsample()
@@ -234,6 +418,76 @@ class SimpleSubsampler(_Subsampler):
                 p = self.alignment.random_part().name
                 self.sample(t, p)
 
+    def subsample_probabilities(self, taxon_probs=None, part_probs=None, matrix=None):
+        """Sample each cell with probability taxon_probs[i] * part_probs[j], where either vector
+        may be omitted (equivalent to all ones), or with probability matrix[i, j] if a full
+        ntaxa x nparts matrix is given instead. Taxa and partitions are in alignment order."""
+
+        import numpy as np
+        self._init_subsample()
+
+        shape = self._sample_bitmap.shape
+        if matrix is not None:
+            if taxon_probs is not None or part_probs is not None:
+                raise ValueError("give either probability vectors or a probability matrix, not both")
+            probs = np.asarray(matrix, dtype=float)
+            if probs.shape != shape:
+                raise ValueError("the probability matrix must have shape " + str(shape))
+        else:
+            probs = np.ones(shape)
+            if taxon_probs is not None:
+                probs *= np.asarray(taxon_probs, dtype=float).reshape(-1, 1)
+            if part_probs is not None:
+                probs *= np.asarray(part_probs, dtype=float).reshape(1, -1)
+
+        self._sample_bitmap = self.rng.random(shape) < probs
+
+        # sample one random partition for any taxon that was left with none
+        empty = np.flatnonzero(~self._sample_bitmap.any(axis=1))
+        if len(empty) > 0 and shape[1] > 0:
+            self._sample_bitmap[empty, self.rng.integers(0, shape[1], len(empty))] = True
+
+class BetaSubsampler(SimpleSubsampler):
+    """A SimpleSubsampler whose per-taxon and per-partition sampling probabilities are drawn from
+    beta distributions. Most partitions get probabilities from PART_BETA, and a LUCKY_PART_FRACTION
+    of them (at least one) from LUCKY_PART_BETA; the probabilities are then sorted and assigned in
+    decreasing order to the partitions, in the order given to subsample() (by default the alignment
+    order). Taxa are treated likewise, except that the lucky taxa are chosen at random."""
+
+    PART_BETA = (3, 5)           # 95% of draws are between 0.1 and 0.71
+    LUCKY_PART_BETA = (4, 3)     # 95% of draws are between 0.22 and 0.88
+    LUCKY_PART_FRACTION = 0.1
+    TAXON_BETA = (3, 5)
+    LUCKY_TAXON_BETA = (8, 1)    # 95% of draws are more than 0.68
+    LUCKY_TAXON_FRACTION = 0.05
+
+    def draw_probabilities(self, order=None):
+        """Return arrays of sampling probabilities for the taxa and the partitions, in alignment
+        order. order is an optional list of the partition labels in decreasing order of rate."""
+
+        import numpy as np
+        rng = self.rng
+        ntaxa, nparts = self._sample_bitmap.shape
+
+        n_lucky = max(int(nparts * self.LUCKY_PART_FRACTION), 1) if nparts > 0 else 0
+        sorted_probs = np.sort(np.concatenate([rng.beta(*self.LUCKY_PART_BETA, size=n_lucky), \
+                                               rng.beta(*self.PART_BETA, size=nparts - n_lucky)]))[::-1]
+        ordinals = [self._part_ordinals[p] for p in order] if order is not None else list(range(nparts))
+        if sorted(ordinals) != list(range(nparts)):
+            raise ValueError("the partition order must list every partition exactly once")
+        part_probs = np.empty(nparts)
+        part_probs[ordinals] = sorted_probs
+
+        taxon_probs = rng.beta(*self.TAXON_BETA, size=ntaxa)
+        n_lucky = max(int(ntaxa * self.LUCKY_TAXON_FRACTION), 1) if ntaxa > 0 else 0
+        taxon_probs[rng.choice(ntaxa, n_lucky, replace=False)] = rng.beta(*self.LUCKY_TAXON_BETA, size=n_lucky)
+
+        return taxon_probs, part_probs
+
+    def subsample(self, order=None):
+        taxon_probs, part_probs = self.draw_probabilities(order)
+        self.subsample_probabilities(taxon_probs, part_probs)
+
 class PhylogeneticSubsampler(_Subsampler):
 
     MAX_RATE = 1000000
@@ -249,6 +503,9 @@ class PhylogeneticSubsampler(_Subsampler):
 
         assert self.MIN_SAMPLED_CLADE_SIZE > self.MIN_SAMPLED_TAXA_PER_CLADE
 
+        self._clear_sampled_nodes()
+
+    def _clear_sampled_nodes(self):
         for p in self.alignment.partitions():
             p.sampled_nodes = set()
         
@@ -333,33 +590,64 @@ class PhylogeneticSubsampler(_Subsampler):
         
         import phylo3, random
         self._init_subsample()
-        
+        self._clear_sampled_nodes()
+
+        # cache leaf counts and depths so they are not recalculated for every node
+        self.tree.annotate()
+        self._leaf_counts = dict([(n, n.leaf_count) for n in self.tree.iternodes()])
+
+        part_labels = list(self.alignment.partition_labels())
+        parts = [self.alignment.get_partition(p) for p in part_labels]
+        rates = [self.rates[p] for p in part_labels]
+        bits = dict((p, 1 << j) for j, p in enumerate(part_labels))
+
+        # the partitions sampled at each node, and at any of its ancestors, as bitmasks over the
+        # partition ordinals. nodes are visited breadth first, so the masks for the parent of a
+        # node are complete by the time the node is reached
+        sampled_here = {}
+        sampled_above = {}
+
         for n in self.tree.breadth_first():
         
 #            if n.is_tip:
-            if len(n.leaves()) < self.MIN_SAMPLED_CLADE_SIZE:
+            if n.leaf_count < self.MIN_SAMPLED_CLADE_SIZE:
                 continue
                 
             if n.is_root:
                 self.set_sampled_partition(n, self.slowest_partition)
+                sampled_here[n] = bits[self.slowest_partition]
                 continue
-            
-            for p in self.alignment.partition_labels():
-                s = self.sampling_rate(n, p)
+
+            above = sampled_above.get(n.parent, 0) | sampled_here.get(n.parent, 0)
+            sampled_above[n] = above
+            here = 0
+
+            # equivalent to sampling_rate(n, p), with the per-node part calculated once
+            relative_depth = n.depth / self.tree_depth
+            for j, p in enumerate(part_labels):
+                s = abs(relative_depth - rates[j]) / (len(parts[j].sampled_nodes) + 1)
             
                 if s > random.random():
-                    if not self.has_parent_sampled_for(n, p):
+                    if not above & bits[p]:
                         self.set_sampled_partition(n, p)
+                        here |= bits[p]
                     else:
                         if self.NESTED_SAMPLING_RATE > random.random():
                             self.set_sampled_partition(n, p)
+                            here |= bits[p]
+
+            sampled_here[n] = here
 
-        # attempt to pick sampled taxa in a way that maximizes lineage representation
+        # attempt to pick sampled taxa in a way that maximizes lineage representation. the
+        # partitions are visited in alignment order, not set order (which varies with the hash
+        # seed), so random numbers are drawn in the same sequence on every run
         for n in self.tree.iternodes(phylo3.PREORDER):
-            for p in n.sampled_partitions:
+            for p in part_labels:
+                if p not in n.sampled_partitions:
+                    continue
 
                 # calculate in advance the proportion of taxa to be sampled for a clade
-                d = len(n.leaves())
+                d = self._leaf_counts[n]
                 
                 # can't be less than MIN_SAMPLED_TAXA_PER_CLADE
                 c = max((d * self.rates[p] * self.reduction_factor), self.MIN_SAMPLED_TAXA_PER_CLADE)
@@ -371,94 +659,133 @@ class PhylogeneticSubsampler(_Subsampler):
 
         # for any unsampled taxa, sample one of the partitions sampled for the closest sampled taxon
         # we could also just sample a random partition...
-        for t in [l.label for l in self.tree.leaves()]:
+        closest = self._closest_sampled_tips()
+        for l in self.tree.leaves():
+            t = l.label
 
             if self.number_parts_sampled_for(t) < 1:
-                part_to_sample = None
-
-                p = n
-                while p.parent is not None:
-                    p = p.parent
-                    for r in [l.label for l in p.leaves()]:
-                        if r != t:
-                            available_parts = list(self.partitions_sampled_for_taxon(r))
-                            if len(available_parts) > 0:
-                                part_to_sample = random.choice(available_parts).name
-                                break
-
-                if part_to_sample is None:
+                r = closest[l]
+                if r is None:
                     raise Exception('could not find a sampled partition for any tip in the tree?')
 
+                part_to_sample = random.choice(list(self.partitions_sampled_for_taxon(r))).name
                 self.sample(t, part_to_sample)
 
+    def _closest_sampled_tips(self):
+        """Return a dict giving, for each node, the label of the sampled tip closest to its nearest
+        ancestor that has any sampled tips below it (or None if there is no such ancestor). For an
+        unsampled tip, that is its closest sampled relative. Built with one postorder pass, which
+        finds the closest sampled tip below each node, and one preorder pass, which hands the
+        answers down the tree."""
+
+        import phylo3
+        is_sampled = self._sample_bitmap.any(axis=1)
+        ordinals = self._taxon_ordinals
+
+        # (edges, label) of the closest sampled tip below each node, or None. ties go to the
+        # earlier child
+        below = {}
+        for n in self.tree.iternodes(phylo3.POSTORDER):
+            if len(n.children) < 1:
+                below[n] = (0, n.label) if n.label in ordinals and is_sampled[ordinals[n.label]] else None
+                continue
+            best = None
+            for c in n.children:
+                b = below[c]
+                if b is not None and (best is None or b[0] + 1 < best[0]):
+                    best = (b[0] + 1, b[1])
+            below[n] = best
+
+        closest = {}
+        for n in self.tree.iternodes(phylo3.PREORDER):
+            if n.parent is None:
+                closest[n] = None
+            else:
+                b = below[n.parent]
+                closest[n] = b[1] if b is not None else closest[n.parent]
+        return closest
+
     def _recur_sample(self, node, count, p):
+        """Distribute count samples for partition p among the tips below node, sampling them.
+        The subtrees are visited depth first with an explicit stack (so deep trees do not hit the
+        recursion limit), in the same order as a recursive traversal would visit them, so random
+        numbers are drawn in the same sequence."""
 
         import random
+        choice = random.choice
+        uniform = random.random
+        rate = self.rates[p]
+        leaf_counts = self._leaf_counts
+
+        stack = [(node, count)]
+        while len(stack) > 0:
+            node, count = stack.pop()
+
+            # if we hit a tip, designate it as sampled and move on
+            if len(node.children) < 1:
+                assert count == 1
+                self.sample(node.label, p)
+                continue
+            else:
+                assert len(node.children) > 0
 
-#        print('starting node' + node_label_string(node) + '; count = ' + str(count))
-
-        # if we hit a tip, designate it as sampled and move on
-        if node.is_tip:
-            assert count == 1
-            self.sample(node.label, p)
-            return
-        else:
-            assert len(node.children) > 0
-
-        # otherwise, we are at an internal node: distribute sample counts to its children
+            # otherwise, we are at an internal node: distribute sample counts to its children
 
-        # if there is only one child, then just move on to it
-        if len(node.children) < 2:
-            return self._recur_sample(node.children[0], count, p)
-        
-        # let t[d] be the number of tips to be sampled within daughter node d
-        t = {}
-        
-        # select the largest and smallest daughters of n (in case n is multifurcating)
-        largest = node.children[0]
-        smallest = node.children[1]
-        size = {}
-        size[largest] = len(largest.leaves())
-        size[smallest] = len(smallest.leaves())
-        for d in node.children:
-            size[d] = len(d.leaves())
-            if size[d] > size[largest]:
-                largest = d
-            elif size[d] < size[smallest]:
-                smallest = d
-
-        # make sure we sample at least one tip from each of these if we can
-        t[largest] = 1
-        x = 1 # keep track of num samples assigned to daughter clades in x
-        if (count > 1):
-            t[smallest] = 1
-            x += 1
-
-        # designate one tip for sampling in as many other daughter clades as we can
-        random.shuffle(node.children) # assign to a random subset if can't do all of them
-        for d in node.children:
-            if x >= count:
-                break
-            if d not in t:
-                t[d] = 1
-                x += 1
-        
-        # attempt to sample any additional tips at the partition-specific rate
-        while x < count:
-            d = random.choice(node.children)
-            if t[d] < size[d] and self.rates[p] > random.random(): 
-                t[d] += 1
+            # if there is only one child, then just move on to it
+            if len(node.children) < 2:
+                stack.append((node.children[0], count))
+                continue
+            
+            # let t[d] be the number of tips to be sampled within daughter node d
+            t = {}
+            
+            # select the largest and smallest daughters of n (in case n is multifurcating)
+            largest = node.children[0]
+            smallest = node.children[1]
+            size = {}
+            size[largest] = leaf_counts[largest]
+            size[smallest] = leaf_counts[smallest]
+            for d in node.children:
+                size[d] = leaf_counts[d]
+                if size[d] > size[largest]:
+                    largest = d
+                elif size[d] < size[smallest]:
+                    smallest = d
+
+            # make sure we sample at least one tip from each of these if we can
+            t[largest] = 1
+            x = 1 # keep track of num samples assigned to daughter clades in x
+            if (count > 1):
+                t[smallest] = 1
                 x += 1
 
-        # recur to distribute the sample counts among the specified descendants down to the tips
-        for d in node.children:
-            if d in t:
-                self._recur_sample(d, t[d], p)
+            # designate one tip for sampling in as many other daughter clades as we can. shuffle a
+            # copy of the children rather than reordering the tree itself
+            children = list(node.children)
+            random.shuffle(children) # assign to a random subset if can't do all of them
+            for d in children:
+                if x >= count:
+                    break
+                if d not in t:
+                    t[d] = 1
+                    x += 1
+            
+            # attempt to sample any additional tips at the partition-specific rate
+            while x < count:
+                d = choice(children)
+                if t[d] < size[d] and rate > uniform(): 
+                    t[d] += 1
+                    x += 1
+
+            # distribute the sample counts among the specified descendants down to the tips. they
+            # are pushed in reverse so that they are processed in the order of children
+            stack.extend([(d, t[d]) for d in reversed(children) if d in t])
         
     def report_sampled_partitions(self):
         for n in self.tree.iternodes():
             print(node_label_string(n))
-            print('    '+','.join(n.sampled_partitions))
+            print('    '+','.join([p for p in self.alignment.partition_labels() if p in n.sampled_partitions]))
+
 
 
 
@@ -483,3 +810,235 @@ class PhylogeneticSubsampler(_Subsampler):
 
 
 
+class Bootstrapper():
+    """Draws bootstrap replicates of an alignment by resampling its columns with replacement, so
+    that each drawn column stays in its own partition. A replicate is drawn from the numpy
+    Generator self.rng as a vector of column weights (the number of times each column was drawn),
+    and written either as a full alignment, with each column repeated as many times as it was
+    drawn and grouped by partition, or as a weighted alignment holding each distinct site pattern
+    of each partition once, with a raxml weights file (for -a) giving how often it was drawn."""
+
+    DEFAULT_LABEL = 'bs'
+
+    def __init__(self, alignment, seed=None):
+        import numpy as np
+        self.alignment = alignment
+        self.rng = np.random.default_rng(seed)
+
+        # the partitions in column order, and the ordinal of the partition holding each column
+        self._parts = sorted(alignment.partitions(), key=lambda p: p.start)
+        self.column_parts = np.full(alignment.ncols, -1, dtype=np.intp)
+        for j, p in enumerate(self._parts):
+            if p.start < 1 or p.end > alignment.ncols or p.end < p.start:
+                raise ValueError("partition " + p.name + " does not fit within the alignment")
+            if np.any(self.column_parts[p.start-1:p.end] >= 0):
+                raise ValueError("partition " + p.name + " overlaps another partition")
+            self.column_parts[p.start-1:p.end] = j
+        if np.any(self.column_parts < 0):
+            raise ValueError("every column of the alignment must belong to a partition")
+
+        self._patterns = None
+
+    def draw_weights(self):
+        """Draw a replicate, and return an array of the number of times each column was drawn."""
+        import numpy as np
+        ncols = self.alignment.ncols
+        return np.bincount(self.rng.integers(0, ncols, size=ncols), minlength=ncols)
+
+    def site_patterns(self):
+        """Return a pair of arrays: the index of one column for each distinct site pattern
+        (column of characters) within each partition, grouped by partition in column order and
+        numbered by first occurrence, and the pattern number of every column. The patterns are
+        found once, by sorting the transposed columns of each partition, and then cached."""
+
+        import numpy as np
+
+        if self._patterns is None:
+            pattern_columns = []
+            column_patterns = np.empty(self.alignment.ncols, dtype=np.intp)
+            n = 0
+            for p in self._parts:
+                # each column, made contiguous, is compared as one opaque value
+                block = np.ascontiguousarray(p.matrix.T)
+                keys = block.view(np.dtype((np.void, block.shape[1]))).ravel() \
+                       if block.shape[1] > 0 else np.zeros(block.shape[0], dtype=np.uint8)
+                first, inverse = np.unique(keys, return_index=True, return_inverse=True)[1:]
+                order = np.argsort(first)
+                rank = np.empty(len(order), dtype=np.intp)
+                rank[order] = np.arange(len(order))
+                pattern_columns.append(p.start - 1 + first[order])
+                column_patterns[p.start-1:p.end] = n + rank[inverse.ravel()]
+                n += len(order)
+            pattern_columns = np.concatenate(pattern_columns) if n > 0 else np.zeros(0, dtype=np.intp)
+            self._patterns = (pattern_columns, column_patterns)
+
+        return self._patterns
+
+    def seed_replicate(self, seed, replicate):
+        """Seed the numpy Generator for one replicate of a batch, from the batch seed and the
+        replicate number only, as _Subsampler.seed_replicate does."""
+        import numpy as np
+        self.rng = np.random.default_rng(np.random.SeedSequence(seed, spawn_key=(replicate,)))
+
+    def replicate_label(self, label=''):
+        """Return the output label (the file names, less their extensions) for a replicate."""
+        return self.alignment.base_name + '.' + \
+            (self.DEFAULT_LABEL + '.' + label if len(label) > 0 else self.DEFAULT_LABEL)
+
+    def write_replicate(self, label='', weights=None, patterns=False, seed=None, replicate=None):
+        """Draw a replicate (unless its column weights are given) and write it as an alignment
+        and a raxml partitions file, or with patterns set, as the weighted site patterns with a
+        weights file as well. Partitions that were not drawn at all are left out. Files are
+        named from self.output_label, which is set here as with _Subsampler. If the batch seed
+        and replicate number it was seeded with are given, they are recorded in a .seed file,
+        which has_replicate checks. Each file is written under a temporary name and renamed
+        when it is complete, and the partitions file (or the .seed file) is written last, so an
+        interrupted replicate never leaves a complete-looking set."""
+
+        import os
+        import numpy as np
+
+        self.output_label = self.replicate_label(label)
+
+        # the record of the seed of any earlier replicate with this label no longer applies
+        if os.path.exists(self.output_label + '.seed'):
+            os.remove(self.output_label + '.seed')
+
+        if weights is None:
+            weights = self.draw_weights()
+
+        if patterns:
+            pattern_columns, column_patterns = self.site_patterns()
+            pattern_weights = np.bincount(column_patterns, weights=weights, \
+                                          minlength=len(pattern_columns)).astype(np.int64)
+            drawn = np.flatnonzero(pattern_weights > 0)
+            columns = pattern_columns[drawn]
+            with _AtomicFile(self.output_label + '.weights', 'w') as w:
+                w.write(' '.join([str(x) for x in pattern_weights[drawn].tolist()]) + '\n')
+        else:
+            # the drawn columns in alignment order, which groups them by partition
+            columns = np.repeat(np.arange(self.alignment.ncols), weights)
+
+        write_columns(self.output_label + '.phy', self.alignment, columns)
+
+        counts = np.bincount(self.column_parts[columns], minlength=len(self._parts))
+        with _AtomicFile(self.output_label + '.part', 'w') as q:
+            last_pos = 0
+            for p, count in zip(self._parts, counts.tolist()):
+                if count > 0:
+                    q.write(p.type + ', ' + p.name + ' = ' + str(last_pos + 1) + '-' + str(last_pos + count) + '\n')
+                    last_pos += count
+
+        if seed is not None:
+            with _AtomicFile(self.output_label + '.seed', 'w') as r:
+                r.write(str(seed) + ' ' + str(replicate) + '\n')
+
+    def has_replicate(self, label='', patterns=False, seed=None, replicate=None):
+        """Return True if the files for the replicate with this label exist and are consistent
+        with the alignment: every taxon has a sequence, the partitions cover the alignment's
+        columns in order, and the replicate has as many columns as the alignment (counting
+        each site pattern as many times as its weight, with patterns set). If a batch seed is
+        given, the replicate must also have been written with that seed and the replicate
+        number, as recorded in its .seed file by write_replicate."""
+
+        import os, phylip
+
+        output_label = self.replicate_label(label)
+        names = [output_label + '.phy', output_label + '.part'] + ([output_label + '.weights'] if patterns else []) \
+                + ([output_label + '.seed'] if seed is not None else [])
+        if not all([os.path.exists(name) for name in names]):
+            return False
+
+        try:
+            if seed is not None:
+                with open(output_label + '.seed') as r:
+                    if r.read().split() != [str(seed), str(replicate)]:
+                        return False
+
+            with phylip.PhylipReader(output_label + '.phy') as reader:
+                if sorted(reader.taxa) != sorted(self.alignment.taxon_labels()):
+                    return False
+                ncols = reader.ncols
+
+            last_pos = 0
+            with open(output_label + '.part') as q:
+                for line in q:
+                    bounds = line.rsplit('=', 1)[1].split('-')
+                    if int(bounds[0]) != last_pos + 1 or int(bounds[1]) < int(bounds[0]):
+                        return False
+                    last_pos = int(bounds[1])
+            if last_pos != ncols:
+                return False
+
+            if patterns:
+                with open(output_label + '.weights') as w:
+                    weights = [int(x) for x in w.read().split()]
+                return len(weights) == ncols and sum(weights) == self.alignment.ncols
+            return ncols == self.alignment.ncols
+
+        except (ValueError, IndexError):
+            return False
+
+    def write_replicates(self, n, label='', seed=None, processes=None, start=1, patterns=False, overwrite=False):
+        """Write n replicates, numbered from start, in a pool of processes (by default one per
+        cpu), as _Subsampler.write_replicates does. Replicate i is seeded with
+        seed_replicate(seed, i), so the same seed always gives the same replicate i, and a
+        batch can be resumed (or any replicate regenerated) by calling this again with the same
+        seed. Unless overwrite is set, replicates that were already written with the same seed
+        and number (see has_replicate) are skipped, and any others with the same label are
+        replaced. If seed is None a random one is chosen. Returns the seed and a list of (output label,
+        True if it was written or False if it was skipped) tuples, in order."""
+
+        import numpy as np
+
+        if seed is None:
+            seed = np.random.SeedSequence().entropy
+        jobs = [(i, (label + '.' if len(label) > 0 else '') + str(i), seed) for i in range(start, start + n)]
+        return seed, _map_replicates((self, patterns, overwrite), _run_bootstrap_replicate, jobs, processes)
+
+def _run_bootstrap_replicate(job):
+    replicate, label, seed = job
+    bootstrapper, patterns, overwrite = _replicate_worker
+    if not overwrite and bootstrapper.has_replicate(label, patterns, seed, replicate):
+        return bootstrapper.replicate_label(label), False
+    bootstrapper.seed_replicate(seed, replicate)
+    bootstrapper.write_replicate(label, patterns=patterns, seed=seed, replicate=replicate)
+    return bootstrapper.output_label, True
+
+class _AtomicFile():
+    """A file opened for writing under a temporary name in the same directory, which replaces
+    filename when it is closed without an error, and is removed otherwise."""
+
+    def __init__(self, filename, mode='w'):
+        import os
+        self.filename = filename
+        self._temp_filename = filename + '.' + str(os.getpid()) + '.tmp'
+        self._file = open(self._temp_filename, mode)
+
+    def __enter__(self):
+        return self._file
+
+    def __exit__(self, exc_type, *exc):
+        import os
+        self._file.close()
+        if exc_type is None:
+            os.replace(self._temp_filename, self.filename)
+        else:
+            os.remove(self._temp_filename)
+
+def write_columns(filename, alignment, columns):
+    """Write a phylip file holding the given columns of the alignment (an array of column
+    indices, which may repeat) for every taxon, in alignment order. Each block of taxa is gathered
+    from the character matrix with a single fancy-indexing operation, and each row is written
+    with a single call. The file only appears under its name once it is complete."""
+
+    rows_per_block = max(1, WRITE_BLOCK_SIZE // max(1, len(columns)))
+    taxa = alignment.taxon_labels()
+    with _AtomicFile(filename, 'wb') as a:
+        a.write('{0} {1}\n'.format(len(taxa), len(columns)).encode('latin-1'))
+        for i in range(0, len(taxa), rows_per_block):
+            block = alignment.matrix[i:i+rows_per_block][:, columns]
+            for r in range(block.shape[0]):
+                a.write(taxa[i + r].encode('latin-1') + b' ')
+                a.write(block[r].tobytes())
+                a.write(b'\n')
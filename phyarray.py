@@ -0,0 +1,228 @@
+"""A compact, array-backed representation of phylogenetic trees. Where a phylo3.Node tree holds a
+python object (with its own dict and lists) for every node, an ArrayTree holds one numpy array per
+field, so a tree with millions of tips takes a few tens of bytes per node, and whole-tree
+calculations run as a few vectorized operations instead of python-level traversals."""
+
+import gc
+import numpy as np
+import phylo3
+
+class ArrayTree():
+    """A rooted tree stored as a struct of arrays. Nodes are numbered in preorder with the root at
+    index 0, so every node is numbered after its parent, and the nodes of any subtree i occupy the
+    contiguous range i to subtree_ends()[i] - 1. For each node i:
+
+        parent[i]        index of the parent (always less than i), or -1 for the root
+        first_child[i]   index of the first child, or -1 if there are none
+        next_sibling[i]  index of the next child of the same parent, or -1 if there is none
+        length[i]        branch length (float64)
+        istip[i]         whether the node is a tip (bool)
+        labels[i]        label, or None
+
+    Comments are kept in a dict of labels by node index, since very few nodes have them.
+
+    The arrays should be treated as read-only; the tree is not meant to be edited in place. To
+    change the topology, convert to phylo3.Node with to_node(), edit, and convert back."""
+
+    def __init__(self, parent, length, labels, istip, comments=None):
+        self.parent = np.asarray(parent, dtype=np.intp)
+        self.length = np.asarray(length, dtype=np.float64)
+        self.istip = np.asarray(istip, dtype=bool)
+        self.labels = list(labels)
+        self.comments = comments if comments is not None else {}
+
+        n = len(self.parent)
+        if not (len(self.length) == len(self.istip) == len(self.labels) == n):
+            raise ValueError("all node fields must have the same length")
+        if n > 0 and (self.parent[0] != -1 or np.any(self.parent[1:] >= np.arange(1, n)) \
+                      or np.any(self.parent[1:] < 0)):
+            raise ValueError("nodes must be in preorder, with the root first")
+
+        # in preorder, the first child of a node immediately follows it
+        self.first_child = np.full(n, -1, dtype=np.intp)
+        if n > 1:
+            has_first = self.parent[1:] == np.arange(n - 1)
+            self.first_child[:-1][has_first] = np.flatnonzero(has_first) + 1
+
+        # siblings keep their preorder order when the nodes are sorted stably by parent
+        self.next_sibling = np.full(n, -1, dtype=np.intp)
+        if n > 1:
+            by_parent = np.argsort(self.parent, kind='stable')
+            same = self.parent[by_parent[:-1]] == self.parent[by_parent[1:]]
+            self.next_sibling[by_parent[:-1][same]] = by_parent[1:][same]
+
+        self._cache = {}
+
+    @classmethod
+    def from_node(cls, root):
+        """Return an ArrayTree with the same topology, branch lengths, labels and comments as the
+        phylo3.Node tree below root. Node.data and excluded_dists are not copied."""
+        parent = []; length = []; labels = []; istip = []; comments = {}
+        stack = [(root, -1)]
+        while len(stack) > 0:
+            n, p = stack.pop()
+            i = len(parent)
+            parent.append(p)
+            length.append(n.length if n.length is not None else 0)
+            labels.append(n.label)
+            istip.append(n.istip)
+            if n.comment is not None:
+                comments[i] = n.comment
+            stack.extend([(c, i) for c in reversed(n.children)])
+        return cls(parent, length, labels, istip, comments)
+
+    def to_node(self):
+        """Return the root of a new phylo3.Node tree with the same topology, branch lengths,
+        labels and comments as this tree."""
+        # as when parsing, the cyclic garbage collector would otherwise repeatedly walk the
+        # partially built tree, since every node is part of a parent/child reference cycle
+        gc_was_enabled = gc.isenabled()
+        gc.disable()
+        try:
+            nodes = []
+            for p, label, length, istip in zip(self.parent.tolist(), self.labels, \
+                                               self.length.tolist(), self.istip.tolist()):
+                node = phylo3.Node()
+                node.label = label
+                node.length = length
+                node.istip = istip
+                if p >= 0:
+                    # link directly, as the parser does, since add_child's membership
+                    # check makes wide polytomies quadratic
+                    parent = nodes[p]
+                    parent.children.append(node)
+                    parent.nchildren += 1
+                    node.parent = parent
+                nodes.append(node)
+            for i, comment in self.comments.items():
+                nodes[i].comment = comment
+        finally:
+            if gc_was_enabled:
+                gc.enable()
+
+        return nodes[0] if len(nodes) > 0 else None
+
+    def __len__(self):
+        return len(self.parent)
+
+    def children(self, i):
+        """Return a list of the indices of the children of node i, in order."""
+        result = []
+        c = self.first_child[i]
+        while c >= 0:
+            result.append(c)
+            c = self.next_sibling[c]
+        return result
+
+    def tips(self):
+        """Return the indices of the tip nodes, in preorder."""
+        return np.flatnonzero(self.istip)
+
+    def _pointer_jump(self, values):
+        """Return, for each node, the sum of values over the node and all of its ancestors. Each
+        round adds in the sums of twice as many ancestors as the last, so the whole calculation
+        takes O(log(height)) vectorized passes over the arrays."""
+        total = np.array(values)
+        up = self.parent.copy()
+        active = np.flatnonzero(up >= 0)
+        while len(active) > 0:
+            above = up[active]
+            total[active] += total[above]
+            up[active] = up[above]
+            active = active[up[active] >= 0]
+        return total
+
+    def levels(self):
+        """Return an array of the number of edges between each node and the root."""
+        if 'levels' not in self._cache:
+            self._cache['levels'] = self._pointer_jump(np.ones(len(self), dtype=np.intp)) - 1
+        return self._cache['levels']
+
+    def root_distances(self):
+        """Return an array of the summed branch lengths from the root to each node (equivalent to
+        phylo3.Node.root_distance after annotating the root). The root's own length is ignored."""
+        n = len(self)
+        if n < 1:
+            return np.zeros(0)
+        return self._pointer_jump(self.length) - self.length[0]
+
+    def subtree_ends(self):
+        """Return an array giving, for each node i, one past the index of the last node in its
+        subtree. That is the index of the next sibling of the closest node (i or one of its
+        ancestors) that has one, or the number of nodes if there is none."""
+        if 'ends' in self._cache:
+            return self._cache['ends']
+
+        n = len(self)
+        ends = self.next_sibling.copy()
+        if n > 0:
+            ends[0] = n
+
+        # resolve each node from the nearest ancestor known to be resolved, doubling the
+        # distance looked up at each round for the nodes that are still unresolved
+        up = self.parent.copy()
+        pending = np.flatnonzero(ends < 0)
+        while len(pending) > 0:
+            above = up[pending]
+            found = ends[above] >= 0
+            ends[pending[found]] = ends[above[found]]
+            pending = pending[~found]
+            up[pending] = up[up[pending]]
+
+        self._cache['ends'] = ends
+        return ends
+
+    def subtree_sizes(self):
+        """Return an array of the number of nodes in the subtree of each node, including itself."""
+        return self.subtree_ends() - np.arange(len(self))
+
+    def leaf_counts(self):
+        """Return an array of the number of tips descended from each node (equivalent to
+        phylo3.Node.leaf_count)."""
+        before = np.zeros(len(self) + 1, dtype=np.intp)
+        np.cumsum(self.istip, out=before[1:])
+        return before[self.subtree_ends()] - before[:-1]
+
+    def depths(self):
+        """Return an array of the depth of each node, i.e. its branch length plus the greatest
+        summed branch length from it to any childless node below it (equivalent to
+        phylo3.Node.depth). Calculated as a range maximum query over the root distances of the
+        childless nodes, which are contiguous in preorder for every subtree."""
+        n = len(self)
+        if n < 1:
+            return np.zeros(0)
+
+        dist = self._pointer_jump(self.length)
+        leaves = np.flatnonzero(self.first_child < 0)
+        lo = np.searchsorted(leaves, np.arange(n))
+        hi = np.searchsorted(leaves, self.subtree_ends())
+
+        # level k of the table holds the max over each run of 2^k consecutive leaves
+        table = [dist[leaves]]
+        while (1 << len(table)) <= len(leaves):
+            prev = table[-1]
+            step = 1 << (len(table) - 1)
+            table.append(np.maximum(prev[:-step], prev[step:]))
+
+        # floor(log2(hi - lo)), exactly
+        k = np.frexp(hi - lo)[1].astype(np.intp) - 1
+        best = np.empty(n)
+        for level in np.unique(k):
+            which = np.flatnonzero(k == level)
+            a = lo[which]
+            b = hi[which] - (1 << level)
+            best[which] = np.maximum(table[level][a], table[level][b])
+
+        return best - dist + self.length
+
+    def postorder(self):
+        """Return an array of the node indices in postorder. A node comes after the nodes that
+        precede it in preorder other than its ancestors, and after its own descendants."""
+        n = len(self)
+        rank = np.arange(n) - self.levels() + self.subtree_sizes() - 1
+        order = np.empty(n, dtype=np.intp)
+        order[rank] = np.arange(n)
+        return order
+
+    def __repr__(self):
+        return "<ArrayTree with %d nodes and %d tips>" % (len(self), int(np.count_nonzero(self.istip)))
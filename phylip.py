@@ -0,0 +1,196 @@
+"""Classes and methods for reading relaxed phylip alignments (as used by RAxML) without loading them
+into memory. The file is memory-mapped and scanned once to find where each sequence starts and ends,
+and sequences are then served directly from the mapped file on request."""
+
+import mmap, os, re
+
+# each line holds one taxon name followed by whitespace and one unbroken sequence. the name and
+# the whitespace are matched; the sequence is everything after them up to the end of the line
+_NAME_RE = re.compile(br'[ \t]*(\S+)[ \t]+(?=\S)')
+
+# written on the first line of saved index files, followed by the size and modification time
+# of the alignment, so indexes of files that have since changed can be recognized
+INDEX_FORMAT = 'phylip-index-1'
+INDEX_SUFFIX = '.idx'
+
+class PhylipReader():
+    """Provides random access to the sequences in a relaxed phylip alignment file, which must have
+    each sequence on a single line. The file is memory-mapped, and an index of the byte offset and
+    length of each sequence is built with one scan over the file, or read from a saved index file
+    (see save_index) if there is a current one. Reading a few sequences from a large alignment
+    therefore costs little more than the scan, and nothing is copied until it is used:
+    view(t) is a zero-copy memoryview of the mapped file, which may be passed to numpy.frombuffer
+    or written directly to a binary file.
+
+    Readers may be used as context managers, which close the mapped file on exit.
+
+    An alignment that is not in a file (read from a stream, for instance) may be given as bytes
+    with data, in which case filename is only used in messages, and there is no saved index."""
+
+    def __init__(self, filename, save_index=False, data=None):
+        self.filename = filename
+        self.index_filename = filename + INDEX_SUFFIX
+
+        if data is not None:
+            self._file = None
+            self._map = bytes(data)
+            # under python 2, slices of the bytes are copies, as for the mapped file
+            self._view = memoryview(self._map) if bytes is not str else self._map
+            self._build_index()
+            return
+
+        self._file = open(filename, 'rb')
+        stat = os.fstat(self._file.fileno())
+        try:
+            mtime = stat.st_mtime_ns
+        except AttributeError: # python 2
+            mtime = int(stat.st_mtime * 1e9)
+        self._stamp = '%d %d' % (stat.st_size, mtime)
+
+        # mmap refuses empty files
+        self._map = mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ) if stat.st_size > 0 else b''
+        try:
+            self._view = memoryview(self._map)
+        except TypeError: # python 2 mmaps only support the old buffer interface, so slices are copies
+            self._view = self._map
+
+        if not self._read_index():
+            self._build_index()
+            if save_index:
+                self.save_index()
+
+    def _build_index(self):
+        data = self._map
+        find = data.find
+        match = _NAME_RE.match
+        size = len(data)
+
+        self.taxa = []
+        self._offsets = {}
+        header = None
+        pos = 0
+        while pos < size:
+            end = find(b'\n', pos)
+            if end < 0:
+                end = size
+            m = match(data, pos, end)
+            if m is not None:
+                # the sequence runs to the end of the line, less any trailing whitespace
+                stop = end
+                while stop > m.end() and data[stop-1:stop] in (b' ', b'\t', b'\r'):
+                    stop -= 1
+                if header is None:
+                    header = (m.group(1), data[m.end():stop])
+                else:
+                    name = m.group(1)
+                    self._add(name if isinstance(name, str) else name.decode('latin-1'), m.end(), stop - m.end())
+            elif data[pos:end].strip():
+                raise ValueError("expected one name and one sequence on the line at byte " + \
+                                 str(pos) + " of " + self.filename)
+            pos = end + 1
+
+        # the first non-blank line holds the numbers of taxa and columns
+        try:
+            self.ntax = int(header[0])
+            self.ncols = int(header[1])
+        except (TypeError, ValueError):
+            raise ValueError("could not read the numbers of taxa and columns in " + self.filename)
+
+        self._validate()
+
+    def _add(self, name, offset, length):
+        if name in self._offsets:
+            raise ValueError("duplicate taxon name '" + name + "' in " + self.filename)
+        self.taxa.append(name)
+        self._offsets[name] = (offset, length)
+
+    def _validate(self):
+        if len(self.taxa) != self.ntax:
+            raise ValueError(self.filename + " has " + str(len(self.taxa)) + " sequences, but the " \
+                             "header specifies " + str(self.ntax))
+        for name, (offset, length) in self._offsets.items():
+            if length != self.ncols:
+                raise ValueError("sequence for '" + name + "' has " + str(length) + " characters, " \
+                                 "but the header of " + self.filename + " specifies " + str(self.ncols))
+
+    def _read_index(self):
+        """Load the saved index if there is one for the current version of the file. Returns True
+        if it was loaded."""
+        if not os.path.exists(self.index_filename):
+            return False
+
+        with open(self.index_filename, 'r') as index_file:
+            if index_file.readline().strip() != INDEX_FORMAT + ' ' + self._stamp:
+                return False
+            self.ntax, self.ncols = [int(n) for n in index_file.readline().split()]
+            self.taxa = []
+            self._offsets = {}
+            for line in index_file:
+                name, offset, length = line.rstrip('\n').rsplit('\t', 2)
+                self._add(name, int(offset), int(length))
+
+        self._validate()
+        return True
+
+    def save_index(self):
+        """Write the index next to the alignment (as filename + INDEX_SUFFIX), so that later
+        readers of the same, unchanged file can skip the scan."""
+        if self._file is None:
+            raise ValueError("there is no file to save an index for")
+        with open(self.index_filename, 'w') as index_file:
+            index_file.write(INDEX_FORMAT + ' ' + self._stamp + '\n')
+            index_file.write('%d %d\n' % (self.ntax, self.ncols))
+            for name in self.taxa:
+                offset, length = self._offsets[name]
+                index_file.write('%s\t%d\t%d\n' % (name, offset, length))
+
+    def __len__(self):
+        return len(self.taxa)
+
+    def __contains__(self, name):
+        return name in self._offsets
+
+    def __iter__(self):
+        return iter(self.taxa)
+
+    def offset(self, name):
+        """Return (offset, length) in bytes of the sequence for name within the file."""
+        return self._offsets[name]
+
+    def view(self, name):
+        """Return the sequence for name as a zero-copy memoryview of the mapped file (or, under
+        python 2, as a copy)."""
+        offset, length = self._offsets[name]
+        return self._view[offset:offset+length]
+
+    def get_bytes(self, name):
+        """Return a copy of the sequence for name as bytes."""
+        return bytes(self.view(name))
+
+    def get_seq(self, name):
+        """Return a copy of the sequence for name as a string."""
+        return bytes(self.view(name)).decode('latin-1')
+
+    def items(self):
+        """Iterate over (name, view) pairs in file order."""
+        for name in self.taxa:
+            yield name, self.view(name)
+
+    def close(self):
+        """Close the file. If views returned by view() are still in use, the mapping stays open
+        until they have all been released."""
+        if isinstance(self._view, memoryview):
+            self._view.release()
+        if isinstance(self._map, mmap.mmap):
+            try:
+                self._map.close()
+            except BufferError:
+                pass
+        if self._file is not None:
+            self._file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
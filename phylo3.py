@@ -6,18 +6,62 @@ import random
 PREORDER = -99999; POSTORDER = 123456
 BRANCHLENGTH = 0; INTERNODES = 1
 
+class _Annotation:
+    '''cached subtree metadata shared by all the nodes of an annotated tree. any change to the
+    topology marks the whole annotation as invalid, so stale values are never used'''
+    def __init__(self, root):
+        self.root = root
+        self.leaves = []
+        self.valid = True
+
+class _LabelIndex:
+    '''map of labels to nodes for a whole tree, owned by its root and shared by all of its nodes.
+    changing the topology or any node label marks the index as invalid, and it is rebuilt the
+    next time it is needed. lookups below other nodes use the same index, checking ancestry'''
+    def __init__(self, root):
+        self.root = root
+        self.nodes_by_label = {} # label -> first node with it in preorder
+        self.duplicates = {} # label -> all nodes with it in preorder, for labels used more than once
+        self.valid = True
+
+    def find(self, label, below):
+        '''return the first node in preorder with the label that is below (or is) the node below,
+        or None'''
+        first = self.nodes_by_label.get(label)
+        if first is None or below is self.root:
+            return first
+        for n in self.duplicates.get(label, (first,)):
+            a = n
+            while a is not None:
+                if a is below:
+                    return n
+                a = a.parent
+        return None
+
 class Node:
     def __init__(self):
+        self._label_index = None
         self.data = {}
 #        self.isroot = False
         self.istip = False
-        self.label = None
+        self._label = None
         self.length = 0
         self.parent = None
         self.children = [] # should probably be using a set
         self.nchildren = 0
         self.excluded_dists = []
         self.comment = None
+        self._annotation = None
+
+    @property
+    def label(self):
+        return self._label
+
+    @label.setter
+    def label(self, label):
+        if self._label_index is not None:
+            self._invalidate_label_index()
+        self._label = label
 
     @property
     def is_root(self):
@@ -45,12 +89,16 @@ class Node:
             if reverse:
                 v.reverse()
             self.children = [ x[-1] for x in v ]
+            # the leaf order of any annotation (and the preorder of the label index) has changed
+            self._invalidate_caches()
             if recurse:
                 for c in self.children:
                     c.order_subtrees_by_size(n2s, recurse=True, reverse=reverse)
 
     def add_child(self, child):
         assert child not in self.children
+        self._invalidate_caches()
+        child._invalidate_caches()
         self.children.append(child)
         child.parent = self
 #        self.nchildren += 1
@@ -59,6 +107,8 @@ class Node:
 
     def remove_child(self, child):
         assert child in self.children
+        self._invalidate_caches()
+        child._invalidate_caches()
         self.children.remove(child)
         child.parent = None
 #        self.nchildren -= 1
@@ -75,23 +125,147 @@ class Node:
 ##         return v
 
     def leaves(self):
+        if self.is_annotated:
+            return self._annotation.leaves[self._leaf_start:self._leaf_end]
         return [ n for n in self.iternodes() if n.istip ]
 
+    def annotate(self):
+        '''calculate and cache the leaf count, depth, distance from self, and the range of leaf
+        indices for every node in the subtree below self (usually the root), in one postorder
+        and one preorder pass. the cached values are discarded when the topology is changed
+        by add_child, remove_child, prune or graft, but NOT when branch lengths are changed;
+        call annotate again after changing branch lengths.'''
+        if self._annotation is not None:
+            self._annotation.valid = False
+        annotation = _Annotation(self)
+        leaves = annotation.leaves
+
+        for n in self.iternodes(POSTORDER):
+            n._annotation = annotation
+            if n.istip:
+                n._leaf_start = len(leaves)
+                leaves.append(n)
+                n._leaf_end = len(leaves)
+            elif len(n.children) < 1:
+                n._leaf_start = n._leaf_end = len(leaves)
+            else:
+                n._leaf_start = n.children[0]._leaf_start
+                n._leaf_end = n.children[-1]._leaf_end
+            n._depth = n.length + (max([c._depth for c in n.children]) if len(n.children) > 0 else 0)
+
+        self._root_distance = 0
+        for n in self.iternodes(PREORDER):
+            if n is not self:
+                n._root_distance = n.parent._root_distance + n.length
+
+    @property
+    def is_annotated(self):
+        return self._annotation is not None and self._annotation.valid
+
+    def _invalidate_annotation(self):
+        if self._annotation is not None:
+            self._annotation.valid = False
+            self._annotation = None
+
+    def _invalidate_label_index(self):
+        # every node of an indexed tree refers to the index, so trees that have never been
+        # indexed (or whose index was already invalidated) are not walked
+        if self._label_index is not None:
+            was_valid = self._label_index.valid
+            self._label_index.valid = False
+            self._label_index = None
+            if not was_valid:
+                return
+            root = self._get_root()
+            if root._label_index is not None:
+                root._label_index.valid = False
+                root._label_index = None
+
+    def _get_root(self):
+        n = self
+        while n.parent is not None:
+            n = n.parent
+        return n
+
+    def _invalidate_caches(self):
+        self._invalidate_annotation()
+        self._invalidate_label_index()
+
+    def _require_annotation(self):
+        if not self.is_annotated:
+            raise ValueError("the tree must be annotated (and not modified since) to use this property")
+
+    @property
+    def leaf_count(self):
+        '''return the number of leaves descended from this node'''
+        if self.is_annotated:
+            return self._leaf_end - self._leaf_start
+        return len(self.leaves())
+
+    @property
+    def root_distance(self):
+        '''return the summed branch length from the annotated root to this node. requires annotation'''
+        self._require_annotation()
+        return self._root_distance
+
+    @property
+    def leaf_range(self):
+        '''return (start, end) such that the leaves descended from this node are the slice
+        start:end of the annotated root's leaves(). requires annotation'''
+        self._require_annotation()
+        return (self._leaf_start, self._leaf_end)
+
+    def _get_label_index(self):
+        '''return the label index of the whole tree that self is part of, building it if it does
+        not exist or if the tree has been changed since it was built. there is only ever one
+        index for a tree, which belongs to its root'''
+        root = self._get_root()
+        index = root._label_index
+        if index is None or not index.valid or index.root is not root:
+            index = _LabelIndex(root)
+            nodes_by_label = index.nodes_by_label
+            duplicates = index.duplicates
+            for node in root.iternodes():
+                node._label_index = index
+                label = node._label
+                if label is None:
+                    continue
+                if label not in nodes_by_label:
+                    nodes_by_label[label] = node
+                elif label in duplicates:
+                    duplicates[label].append(node)
+                else:
+                    duplicates[label] = [nodes_by_label[label], node]
+        return index
+
     def get_node_for_name(self, inname):
-        for node in self.iternodes():
-            if node.label == inname:
-                return node
-        return None
+        '''return the first node (in preorder) below self with the label, or None. labels are
+        looked up in an index of the whole tree that is built on the first call and kept until
+        the tree changes'''
+        return self._get_label_index().find(inname, self)
+
+    def get_nodes_for_names(self, innames):
+        '''look up many labels at once. returns a dict mapping the labels that were found to their
+        nodes, and a list of the labels that were not found'''
+        index = self._get_label_index()
+        found = {}
+        missing = []
+        for name in innames:
+            node = index.find(name, self)
+            if node is None:
+                missing.append(name)
+            else:
+                found[name] = node
+        return found, missing
 
     def breadth_first(self):
         '''return nodes in breadth first order starting at this node'''
-        stack = [self,]
-        nodes = []
-        while len(stack) > 0:
-            n = stack.pop(0)
-            nodes.append(n)
-            for child in n.children:
-                stack.append(child)
+        # the list of nodes is its own queue; i is the position of the next node to expand
+        nodes = [self,]
+        i = 0
+        while i < len(nodes):
+            nodes.extend(nodes[i].children)
+            i += 1
         return nodes
 
     def branch_lengths(self):
@@ -102,15 +276,39 @@ class Node:
         return sum(self.branch_lengths())
 
     def iternodes(self, order=PREORDER, v=None):
-        '''returns a list of nodes descendant from self - including self'''
-        if order == PREORDER:
-            yield self
-        random.shuffle(self.children)
-        for child in self.children:
-            for d in child.iternodes(order):
-                yield d
+        '''returns an iterator over the nodes descendant from self - including self. children
+        are visited in order, and an explicit stack is used so that very deep trees do not
+        exceed the recursion limit'''
+        return self._iternodes(order, shuffle=False)
+
+    def iternodes_random(self, order=PREORDER):
+        '''like iternodes, but visits the children of each node in a random order. the tree
+        itself is not modified'''
+        return self._iternodes(order, shuffle=True)
+
+    def _iternodes(self, order, shuffle):
         if order == POSTORDER:
-            yield self
+            # nodes are pushed twice: first to expand their children, then to be yielded
+            stack = [(self, False)]
+            while len(stack) > 0:
+                n, expanded = stack.pop()
+                if expanded or len(n.children) < 1:
+                    yield n
+                    continue
+                stack.append((n, True))
+                children = n.children[::-1]
+                if shuffle:
+                    random.shuffle(children)
+                stack.extend([(c, False) for c in children])
+        else:
+            stack = [self,]
+            while len(stack) > 0:
+                n = stack.pop()
+                yield n
+                children = n.children[::-1]
+                if shuffle:
+                    random.shuffle(children)
+                stack.extend(children)
 
     def descendants(self, order=PREORDER, v=None):
         '''returns a list of nodes descendant from self - not including self!'''
@@ -127,14 +325,7 @@ class Node:
         return v
 
     def find_descendant(self, label):
-        if label == self.label:
-            return self
-        else:
-            for child in self.children:
-                n = child.find_descendant(label)
-                if n:
-                    return n
-        return None
+        return self.get_node_for_name(label)
 
     def prune(self, logfile=None):
         
@@ -190,17 +381,21 @@ class Node:
         return p
     
     def _calc_depth(self):
-        '''recursively calculate the depth of this node'''
-        if len(self.children) < 1:
-            return self.length
-        else:
-            return self.length + max([c.depth for c in self.children])
+        '''calculate the depth of this node with a postorder traversal of its subtree'''
+        depths = {}
+        for n in self.iternodes(POSTORDER):
+            if len(n.children) < 1:
+                depths[n] = n.length
+            else:
+                depths[n] = n.length + max([depths.pop(c) for c in n.children])
+        return depths[self]
 
     @property
     def depth(self):
         '''return the depth of this node in the tree'''
-        # currently just calculating the depth for every call. should really store this
-        # and just update it when necessary
+        # only calculated once per call to annotate() if the tree has been annotated
+        if self.is_annotated:
+            return self._depth
         return self._calc_depth()
 
     def graft(self, node):
@@ -398,6 +593,57 @@ def get_tree_rooted_on(target_node):
 #	new_root.isroot = True
 	return new_root
 
+def prune_tips(tree, labels, logfile=None):
+    '''remove every tip whose label is in labels from the tree, in a single postorder pass that
+    rebuilds the child lists of the remaining nodes. internal nodes left with no children are
+    removed, and nodes left with one child (knuckles) are collapsed, adding their branch length
+    to that of the child. returns the new root, which will differ from the old one if the root was
+    collapsed, or None if every tip was removed.'''
+
+    labels = set(labels)
+
+    # the children lists are rewritten directly, so discard any cached annotation or label index
+    tree._invalidate_caches()
+
+    # map each processed node to the node that replaces it in the pruned tree, or None if it has
+    # been removed. entries are discarded once the parent has been processed
+    replacement = {}
+    for n in tree.iternodes(POSTORDER):
+        if len(n.children) < 1:
+            if n.istip and n.label not in labels:
+                replacement[n] = n
+            else:
+                if logfile is not None and n.istip:
+                    logfile.write("removing " + n.label + "\n")
+                n.parent = None
+                replacement[n] = None
+            continue
+
+        children = [replacement.pop(c) for c in n.children]
+        children = [c for c in children if c is not None]
+        if len(children) < 1:
+            replacement[n] = None
+        elif len(children) == 1:
+            # collapse the knuckle. the root has no subtending branch, so only non-root
+            # knuckles add their length to the child
+            only_child = children[0]
+            if n is not tree:
+                only_child.length += n.length
+            n.children = []
+            n.nchildren = 0
+            replacement[n] = only_child
+        else:
+            for c in children:
+                c.parent = n
+            n.children = children
+            n.nchildren = len(children)
+            replacement[n] = n
+
+    root = replacement[tree]
+    if root is not None:
+        root.parent = None
+    return root
+
 def node2size(node, d=None):
     "map node and descendants to number of descendant tips"
     if d is None:
@@ -430,11 +676,95 @@ def reroot(oldroot, newroot): # needs some work
         cp.length = node.length
     return newroot
 
+class MRCAIndex():
+    '''Answers most recent common ancestor queries on a tree in constant time per pair of nodes,
+    after an O(n log n) setup. Nodes are numbered in preorder (the order of first visits in an
+    Euler tour), and for any two nodes u and v with u before v, their mrca is the parent of the
+    shallowest node numbered after u up to v. That range minimum query is answered from a sparse
+    table. The mrca of any set of nodes is the mrca of the first and last of them in preorder, so
+    a set of k names takes k dict lookups plus a single range minimum query.
+
+    The index is a snapshot; it must be rebuilt if the topology of the tree is changed.'''
+
+    def __init__(self, tree):
+        from array import array
+
+        self.tree = tree
+        self.nodes_by_label = {}
+        self._order = []
+        self._position = {}
+        depths = array('l')
+
+        stack = [(tree, 0)]
+        while len(stack) > 0:
+            n, d = stack.pop()
+            self._position[n] = len(self._order)
+            self._order.append(n)
+            depths.append(d)
+            if n.label is not None and n.label not in self.nodes_by_label:
+                self.nodes_by_label[n.label] = n
+            stack.extend([(c, d + 1) for c in reversed(n.children)])
+
+        # level k of the table holds, for each position i, the position of the shallowest
+        # node in the range i to i + 2^k - 1
+        self._depths = depths
+        self._table = [array('l', range(len(depths)))]
+        k = 1
+        while (1 << k) <= len(depths):
+            prev = self._table[-1]
+            step = 1 << (k - 1)
+            self._table.append(array('l', [a if depths[a] <= depths[b] else b \
+                                           for a, b in zip(prev, prev[step:])]))
+            k += 1
+
+    def _shallowest(self, i, j):
+        '''return the position of the shallowest node between positions i and j, inclusive'''
+        k = (j - i + 1).bit_length() - 1
+        level = self._table[k]
+        a = level[i]
+        b = level[j - (1 << k) + 1]
+        return a if self._depths[a] <= self._depths[b] else b
+
+    def get_node_for_name(self, name):
+        return self.nodes_by_label.get(name)
+
+    def mrca(self, node1, node2):
+        '''return the mrca of two nodes in the indexed tree'''
+        i = self._position[node1]
+        j = self._position[node2]
+        if i == j:
+            return node1
+        if i > j:
+            i, j = j, i
+        return self._order[self._shallowest(i + 1, j)].parent
+
+    def mrca_of_nodes(self, nodes):
+        '''return the mrca of a collection of nodes in the indexed tree, or None if it is empty'''
+        positions = [self._position[n] for n in nodes]
+        if len(positions) < 1:
+            return None
+        i = min(positions)
+        j = max(positions)
+        if i == j:
+            return self._order[i]
+        return self._order[self._shallowest(i + 1, j)].parent
+
+    def mrca_for_names(self, names):
+        '''return the mrca of the nodes with the given labels. names that are not in the tree are
+        ignored, and None is returned if none of them are.'''
+        nodes_by_label = self.nodes_by_label
+        return self.mrca_of_nodes([nodes_by_label[name] for name in names if name in nodes_by_label])
+
 # DEPRECATED, use get_mrca()
-def getMRCA(tree, innames):
-	return get_mrca(tree, innames)
+def getMRCA(tree, innames, index=None):
+	return get_mrca(tree, innames, index)
+
+def get_mrca(tree, innames, index=None):
+    '''return the mrca of the named nodes in the tree. if an MRCAIndex for the tree is
+    supplied then it will be used to answer the query without searching the tree'''
 
-def get_mrca(tree, innames):
+    if index is not None:
+        return index.mrca_for_names(innames)
 
     # find a name in the tree to start from
     i = 0
@@ -502,7 +832,10 @@ def get_first_mrca_index_for_paths(guide_path, compare_path):
 #        mrca = cur1
 #    return mrca
 
-def getMRCATraverse(curn1, curn2):
+def getMRCATraverse(curn1, curn2, index=None):
+    if index is not None:
+        return index.mrca(curn1, curn2)
+
     mrca = None
     #get path to root for first node
     path1 = []
@@ -23,6 +23,7 @@ if __name__ == '__main__':
 
     avg = numpy.mean(lengths)
 
+    badnames = []
     for tip in tree.leaves():
     
         if tip.parent == tree:
@@ -31,32 +32,12 @@ if __name__ == '__main__':
         if tip.length > avg * maxdevfactor:
             if tip.label not in keepnames:
                 print "pruning " + tip.label
-                tip.prune()
-
-            # compress knuckle if there is one
-    #        if len(parent.children) == 1:
-    #            child = parent.children[0]
-    #            if child.label != None:
-    #                rightlabel = child.label
-    #            else:
-    #                rightlabel = ", ".join([leaf.label for leaf in child.leaves()])
-    #            print "compressing a knuckle in the tree: " + leftlabel + " | " + rightlabel
-    #            pp = parent.parent
-    #            pp.remove_child(parent)
-    #            pp.add_child(child)
-
-    #nodes_to_remove = []
-    for n in tree.descendants():
-
-        nc = n
-        while (not nc.istip) and len(nc.children) == 0:
-            print "pruning an empty tip"
-            np = nc.parent
-            nc.prune()
-            if np:
-                nc = np
-            else:
-                break
+                badnames.append(tip.label)
+
+    # remove the long tips, and any empty clades or knuckles left behind, in one pass
+    tree = phylo3.prune_tips(tree, badnames)
+    if tree is None:
+        sys.exit("every tip of the tree in " + treefname + " was pruned, leaving no tree to write")
 
     outfile = open(treefname.rsplit(".tre",1)[0] + ".pruned.tre","w")
     outfile.write(newick3.tostring(tree) + ";")
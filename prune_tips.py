@@ -11,53 +11,24 @@ if __name__ == '__main__':
 
     badnamesfname = sys.argv[1]
     badnamesfile = open(badnamesfname, "r")
-    badnames = [name.strip() for name in badnamesfile.readlines()]
+    badnames = set([name.strip() for name in badnamesfile.readlines()])
 
     #print badnames
 
     treefname = sys.argv[2]
-    treefile = open(treefname, "r")
     #outfname = sys.argv[3]
     #outfile = open(outfname,"w")
 
     logfile = open("prunetips.log","w")
 
-    for line in treefile:
+    for i, tree in enumerate(newick3.iter_trees(treefname)):
 
-        tree = newick3.parse(line)
     #    print "in tree: " + newick3.to_string(tree) + ";"
 
-        # prune the bad tips
-        for tip in tree.leaves():
-
-            name_ok = False
-
-            if tip.label in badnames:
-                leftlabel = tip.label
-    #            print "removing " + leftlabel
-    #            logfile.write("removing " + leftlabel)
-                tip.prune(logfile)
-            else:
-                name_ok = True
-
-        # remove any leftover empty tip nodes    
-        if not name_ok:
-            for n in tree.descendants():
-
-                nc = n
-                while (not nc.istip) and len(nc.children) == 0:
-     #               print "pruning an empty tip"
-                    logfile.write("pruning an empty tip")
-                    np = nc.parent
-                    nc.prune()
-
-                    if np:
-                        # prepare for next step back
-                        nc = np
-
-                    # if we hit the root of the tree, move on to next descendant
-                    else:
-                        break
+        # prune the bad tips, and any empty clades or knuckles left behind, in one pass
+        tree = phylo3.prune_tips(tree, badnames, logfile)
+        if tree is None:
+            sys.exit("every tip of tree " + str(i + 1) + " in " + treefname + " was pruned, leaving no tree to write")
 
         print newick3.to_string(tree) + ";"
 
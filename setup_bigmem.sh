@@ -18,12 +18,6 @@ mv raxmlHPC-$RAXMLTYPE-PTHREADS ~/bin
 mv raxmlHPC-$RAXMLTYPE ~/bin
 cd ../
 
-# phyx
-git clone git@github.com:FePhyFoFum/phyx.git
-cd phyx/src
-make -f Makefile.in pxbp
-mv pxbp ~/bin
-
 # physcripts
 git clone http://github.com/chinchliff/physcripts.git
 mv physcripts scripts
@@ -2,7 +2,7 @@
 
 '''Subsample an alignment using a tree.'''
 
-from phyaln import Alignment, PhylogeneticSubsampler
+from phyaln import Alignment, PhylogeneticSubsampler, write_replicates_and_exit
 
 def read_rate_file(f):
     with open(f, 'r') as infile:
@@ -40,13 +40,31 @@ if __name__ == '__main__':
     parser.add_argument('-n', '--output-label', required=False, default='', \
         help='a label to be attached to output files')
 
+    parser.add_argument('-N', '--replicates', type=int, default=1, \
+        help='the number of replicate subsamples to generate. when more than one is requested, the ' \
+             'replicate number is appended to the output label of each.')
+
+    parser.add_argument('-T', '--processes', type=int, required=False, \
+        help='the number of processes to use for generating replicates (default: one per cpu)')
+
+    parser.add_argument('-s', '--start', type=int, default=1, \
+        help='the number of the (first) replicate (default 1). each replicate is seeded from the ' \
+             'random seed and its own number, so a single replicate (-N 1) made with the same ' \
+             'random seed and -s i reproduces replicate i of a batch.')
+
     args = parser.parse_args()
     
     a = Alignment(args.alignment, args.partitions)
     t = newick3.parse(args.tree)
-    f = args.reduction_factor if 'reduction_factor' in args else 1
+    f = args.reduction_factor if args.reduction_factor is not None else 1
     
     s = PhylogeneticSubsampler(alignment=a, tree=t, rates=args.rates, reduction_factor=f)
+
+    if args.replicates > 1:
+        write_replicates_and_exit(s, args.replicates, args.output_label, args.random_seed, args.processes, args.start)
+
+    if args.random_seed is not None:
+        s.seed_replicate(args.random_seed, args.start)
     
     s.subsample()
 
@@ -2,7 +2,7 @@
 
 '''Subsample an alignment uniformly at random.'''
 
-from phyaln import Alignment, SimpleSubsampler
+from phyaln import Alignment, SimpleSubsampler, write_replicates_and_exit
     
 if __name__ == '__main__':
 
@@ -27,16 +27,36 @@ if __name__ == '__main__':
     parser.add_argument('-n', '--output-label', required=False, default='', \
         help='a label to be attached to output files')
 
+    parser.add_argument('-N', '--replicates', type=int, default=1, \
+        help='the number of replicate subsamples to generate. when more than one is requested, the ' \
+             'replicate number is appended to the output label of each.')
+
+    parser.add_argument('-T', '--processes', type=int, required=False, \
+        help='the number of processes to use for generating replicates (default: one per cpu)')
+
+    parser.add_argument('-s', '--start', type=int, default=1, \
+        help='the number of the (first) replicate (default 1). each replicate is seeded from the ' \
+             'random seed and its own number, so a single replicate (-N 1) made with the same ' \
+             'random seed and -s i reproduces replicate i of a batch.')
+
     args = parser.parse_args()
     
     a = Alignment(args.alignment, args.partitions)
     s = SimpleSubsampler(a)
-    
-    random.seed()
-    sampling_proportion = 0.5
-    s.subsample(lambda: random.random() >= 0.5)
+
+    # draw the whole sampling matrix at once, every cell with the same probability
+    part_probs = [args.sampling_proportion] * a.nparts()
+
+    if args.replicates > 1:
+        write_replicates_and_exit(s, args.replicates, args.output_label, args.random_seed, args.processes, args.start, \
+                                  method='subsample_probabilities', args=(None, part_probs))
+
+    if args.random_seed is not None:
+        s.seed_replicate(args.random_seed, args.start)
+
+    s.subsample_probabilities(part_probs=part_probs)
 
     s.write_subsampled_output(args.output_label)
     
-    print('files have been written to: ' + s.output_label + '.sampling_matrix.txt, ' + s.output_label + '.subsampled.phy\n' \
+    print('files have been written to: ' + s.output_label + '.sampling_matrix.tsv, ' + s.output_label + '.phy\n' \
               'sampling proportion is ' + str(s.get_sampling_proportion()))
@@ -6,29 +6,220 @@ We may then perform a number of replicated topology searches consisting of rando
 
 _title = "Estimate quartet jackknife ICA support on a tree" 
 
-import argparse, newick3, os, phylo3, random, shutil, subprocess, sys, time
-from multiprocessing import Lock, Manager, Pool, Queue
-from io import StringIO
+import argparse, bipartitions, hashlib, multiprocessing, newick3, os, phylip, phylo3, random, re, shutil, subprocess, sys, tempfile, time
+import numpy as np
 
 DEFAULT_RAXML = "raxmlHPC-AVX"
 SECONDS_PER_MINUTE = 60
 MINUTES_PER_HOUR = 60
 SECONDS_PER_HOUR = SECONDS_PER_MINUTE * MINUTES_PER_HOUR
 
+JOURNAL_FILE_NAME = "journal.tsv"
+SCORED = "scored"
+
+# the characters raxml treats as undetermined for each data type. partitions of any other type are
+# protein partitions, named by their model. without a partitions file, the data are DNA (GTRCAT)
+GAP = ord("-")
+UNDETERMINED = {"DNA" : b"-?NOX", "BIN" : b"-?", "MULTI" : b"-?"}
+UNDETERMINED_PROTEIN = b"-?X"
+
+# maps every byte to its upper case
+_UPPER = np.frombuffer(bytes(bytearray(range(256))).upper(), dtype=np.uint8)
+
+class Journal():
+    """An append-only record of the work completed by a run, kept in the results dir so that an
+    interrupted run can be continued by starting it again with the same arguments. The first line
+    records the settings of the run (a list of (name, value) pairs), as
+
+        # <tab> name=value <tab> name=value ...
+
+    and a journal is only reopened by a run with the same settings, since replicates made with
+    different settings cannot be scored together. Each later line records either the topology
+    found by one replicate for a node, as
+
+        split key <tab> replicate number <tab> topology
+
+    or the scores for a node once all of its replicates are done, as
+
+        split key <tab> scored <tab> freq <tab> ica
+
+    Nodes are identified by split_key(), so the records do not depend on the order in which the
+    nodes of the tree are visited. Each record is written with a single call and flushed to disk
+    before the run moves on. A line left incomplete by a killed run is ignored."""
+
+    def __init__(self, path, settings, restart=False):
+        self.path = path
+        self.header = "\t".join(["#"] + [str(name) + "=" + str(value) for name, value in settings])
+        self.topologies = {} # split key -> {replicate number: topology}
+        self.scores = {} # split key -> (freq, ica)
+
+        if restart and os.path.exists(path):
+            os.remove(path)
+
+        # if the last line is incomplete, it is dropped here
+        lines = []
+        ends_with_newline = True
+        if os.path.exists(path):
+            with open(path, "r") as journal_file:
+                data = journal_file.read()
+            ends_with_newline = len(data) < 1 or data.endswith("\n")
+            lines = data.split("\n")[:-1]
+
+        if len(lines) > 0 and lines[0] != self.header:
+            old = dict([f.split("=", 1) for f in lines[0].split("\t")[1:] if "=" in f]) if lines[0].startswith("#") else {}
+            changed = [name for name, value in settings if old.get(name) != str(value)]
+            raise ValueError("The journal " + path + " was written by a run with different settings (" + \
+                             ", ".join(changed) + "). Use --restart to discard it and start over, or use a different results dir.")
+
+        for line in lines[1:]:
+            parts = line.split("\t")
+            try:
+                if len(parts) == 4 and parts[1] == SCORED:
+                    self.scores[parts[0]] = (parts[2], parts[3])
+                elif len(parts) == 3:
+                    self.topologies.setdefault(parts[0], {})[int(parts[1])] = parts[2]
+            except ValueError:
+                continue
+
+        if len(lines) < 1:
+            # a new journal, or one in which not even the settings were completely written
+            self._file = open(path, "w")
+            self.record(self.header)
+        else:
+            self._file = open(path, "a")
+            if not ends_with_newline:
+                # start a new line after the incomplete one
+                self._file.write("\n")
+
+    def record(self, *fields):
+        self._file.write("\t".join([str(f) for f in fields]) + "\n")
+        self._file.flush()
+        os.fsync(self._file.fileno())
+
+    def close(self):
+        self._file.close()
+
+def file_stamp(path):
+    """Return the size and modification time of a file, to recognize when it has changed."""
+    stat = os.stat(path)
+    return "%d %d" % (stat.st_size, stat.st_mtime_ns)
+
+def split_key(index, bits):
+    """Return a short key for the unrooted bipartition with bits on one side, which is the same
+    for both sides and for any tree with the same leaf labels (the index must be sorted, as from
+    bipartitions.BipartitionIndex.for_tree)."""
+    return hashlib.sha1(("%x" % index.canonical(bits)).encode()).hexdigest()
+
+def read_partitions(path):
+    """Read a raxml partitions file, with lines like "DNA, gene1 = 1-500, 601-700\\3". Returns a
+    list of (type, name, columns) for the partitions, where columns is an array of the zero-based
+    indices of the alignment columns in the partition."""
+
+    partitions = []
+    with open(path, "r") as parts_file:
+        for line in parts_file:
+            if len(line.strip()) < 1:
+                continue
+            m = re.match(r"\s*([^,=]+?)\s*,\s*([^=]+?)\s*=(.+)$", line)
+            if m is None:
+                raise ValueError("could not read the partition '" + line.strip() + "' in " + path)
+
+            columns = []
+            for r in m.group(3).split(","):
+                bounds = re.match(r"\s*(\d+)\s*(?:-\s*(\d+))?\s*(?:\\\s*(\d+))?\s*$", r)
+                if bounds is None:
+                    raise ValueError("could not read the columns of partition " + m.group(2) + " in " + path)
+                start = int(bounds.group(1))
+                end = int(bounds.group(2)) if bounds.group(2) is not None else start
+                stride = int(bounds.group(3)) if bounds.group(3) is not None else 1
+                columns.append(np.arange(start - 1, end, stride))
+
+            partitions.append((m.group(1), m.group(2), np.concatenate(columns)))
+
+    return partitions
+
+def column_ranges(columns):
+    """Return the sorted column indices (zero-based) as a string of one-based ranges in the format
+    of a raxml partitions file."""
+    breaks = np.flatnonzero(np.diff(columns) != 1) + 1
+    starts = columns[np.concatenate([[0], breaks])] + 1
+    ends = columns[np.concatenate([breaks - 1, [len(columns) - 1]])] + 1
+    return ", ".join([str(a) if a == b else str(a) + "-" + str(b) for a, b in zip(starts.tolist(), ends.tolist())])
+
+def reduce_alignment(seqs, partitions):
+    """Find the sequences that are identical to others (ignoring case, and treating all the
+    undetermined characters as the same) and the columns that are entirely undetermined, as raxml
+    would when validating the alignment. Returns (keep, columns, identical), where keep is the
+    list of names whose sequences are to be used, in order, columns is a boolean mask of the
+    columns to be used, and identical maps each kept name that has identical sequences to the set
+    of their names."""
+
+    names = list(seqs.keys())
+    matrix = _UPPER[np.vstack([np.frombuffer(seqs[n], dtype=np.uint8) for n in names])]
+
+    # make every undetermined character a gap, according to the data type of its column
+    for data_type, name, columns in partitions:
+        block = matrix[:, columns]
+        block[np.isin(block, np.frombuffer(UNDETERMINED.get(data_type.upper(), UNDETERMINED_PROTEIN), dtype=np.uint8))] = GAP
+        matrix[:, columns] = block
+
+    columns = np.any(matrix != GAP, axis=0)
+
+    # each sequence is looked up by its contents, so the first of each set of identical sequences
+    # is kept and the others are recorded against it
+    keep = []
+    first_with_seq = {}
+    identical = {}
+    for i, n in enumerate(names):
+        row = matrix[i].tobytes()
+        if row in first_with_seq:
+            identical.setdefault(first_with_seq[row], set()).add(n)
+        else:
+            first_with_seq[row] = n
+            keep.append(n)
+
+    return keep, columns, identical
+
+def default_temp_dir():
+    """Return a tmpfs (memory-backed) directory for temporary files if there is a writable one,
+    or otherwise a "temp" directory in the current working directory."""
+    for d in ("/dev/shm", "/run/shm"):
+        if os.path.isdir(d) and os.access(d, os.W_OK):
+            return d
+    return os.path.abspath("./temp")
+
 def process_replicate(replicate):
+    """Run the raxml search for one replicate, and return the result to be scored with the
+    other replicates of its node. This is called in the worker processes of the pool, which
+    inherit the alignment reader (aln), the partitions and the run settings from the main
+    process. Each replicate runs in its own scratch directory inside the run's directory
+    (run_dir), which is removed as soon as the result tree has been read from it."""
 
-    os.chdir(temp_wd)
+    scratch_dir = tempfile.mkdtemp(prefix="rep.", dir=run_dir)
+    try:
+        return run_replicate(replicate, scratch_dir)
+    finally:
+        shutil.rmtree(scratch_dir, ignore_errors=True)
+
+def run_replicate(replicate, scratch_dir):
 
     # just alias dictionary elements for convenience
-    queue = replicate["queue"]
-    lock = replicate["lock"]
     using_partitions = replicate["using_partitions"]
     node_id = replicate["node_id"]
     replicate_id = replicate["replicate_id"]
     raxml_path = replicate["raxml_path"]
-    all_seqs = replicate["seqs"]
+
+    # the sequences for the exemplars are read here rather than sent with the task, so tasks stay
+    # small however long the alignment is
+    all_seqs = {}
+    for subtree_name, exemplars in replicate["exemplars"].items():
+        all_seqs[subtree_name] = dict([(q, aln.get_bytes(l)) for q, l in exemplars.items()])
 
     result = {}
+    result["node_id"] = node_id
+    result["split_key"] = replicate["split_key"]
+    result["replicate_id"] = replicate_id
+    result["exemplars"] = replicate["exemplars"]
     result["seq_labels"] = {}
     for w in "LR":
         result["seq_labels"][w] = []
@@ -39,14 +230,10 @@ def process_replicate(replicate):
     # generate a label that will be unique within this run (but probably not among runs!)
     unique_label = node_id + "." + replicate_id
         
-    # generate labels for temp files
-    if using_partitions:
-        # make a copy of the partitions file
-        temp_part_fname = "temp_parts." + unique_label
-        subprocess.call("cp temp_parts " + temp_part_fname, shell=True)
-    
-    temp_aln_fname = "temp_inseqs." + unique_label
-    temp_aln_test_read_label = "temp_read_aln." + unique_label
+    # generate labels for temp files. these are all in the replicate's own directory, where raxml
+    # also writes its output
+    temp_aln_fname = os.path.join(scratch_dir, "temp_inseqs")
+    temp_part_fname = os.path.join(scratch_dir, "temp_parts")
     temp_ml_search_label = "temp_tree_search." + unique_label
 
     seqs = {}
@@ -54,59 +241,26 @@ def process_replicate(replicate):
         for i, s in subtree_seqs.items():
             seqs[subtree_name+"_"+str(i)] = s
 
+    # remove identical sequences and entirely undetermined columns here rather than with a
+    # separate raxml validation run (-f c), since starting raxml is most of the cost of searching
+    # a quartet
+    keep, columns, result["identical"] = reduce_alignment(seqs, partitions)
+
     # write the alignment
-    with open(temp_aln_fname,"w") as outfile:
-        outfile.write(str(len(seqs)) + " " + str(len(seqs[list(seqs.keys())[0]])) + "\n")
-        for l, s in seqs.items():
-            outfile.write(l + " " + s + "\n")
-    
-    # test alignment readability by raxml, also filters entirely missing columns
-    raxml_args = [raxml_path, 
-        "-s", temp_aln_fname, 
-        "-n", temp_aln_test_read_label, 
-        "-m", "GTRCAT", 
-        "-f", "c",
-        "-$", ] # silent alignment validation mode, currently on chinchliff branch
-#        "--silent" ] # silent alignment validation mode, waiting for standard-raxml to work
+    with open(temp_aln_fname, "wb") as outfile:
+        outfile.write((str(len(keep)) + " " + str(int(np.count_nonzero(columns))) + "\n").encode())
+        for l in keep:
+            outfile.write(l.encode() + b" " + np.frombuffer(seqs[l], dtype=np.uint8)[columns].tobytes() + b"\n")
 
+    # and the partitions, renumbered for the remaining columns. partitions with no remaining
+    # columns are left out
     if using_partitions:
-        raxml_args += ["-q", temp_part_fname]
-
-    p = subprocess.Popen(raxml_args, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
-    res = str(p.communicate()[0])
-    identical_seqs = {}
-    if res != None:
-#        print(res)
-        for line in res.split("\n"):
-            if line.find("IMPORTANT WARNING:") >= 0:
-                parts = line.split()
-                if parts[3] == "validation":
-                    continue
-
-                n1 = parts[3]
-                n2 = parts[5]
-
-                if n1 not in identical_seqs:
-                    identical_seqs[n1] = set()
-                identical_seqs[n1].add(n2)
-
-#    print(identical_seqs)
-    result["identical"] = {}
-    for r in identical_seqs.keys():
-        result["identical"][r] = set()
-        result["identical"][r].update(identical_seqs[r])
-        for m in identical_seqs[r]:
-            if m in identical_seqs:
-                result["identical"][r].update(identical_seqs[m])
-    
-#    print(result["identical"])
-#    exit()
-    
-    if os.path.exists(temp_aln_fname + ".reduced"):
-        temp_aln_fname = temp_aln_fname + ".reduced"
-        
-    if using_partitions and os.path.exists(temp_part_fname + ".reduced"):
-        temp_part_fname = temp_part_fname + ".reduced"
+        new_index = np.cumsum(columns) - 1
+        with open(temp_part_fname, "w") as outfile:
+            for data_type, name, part_columns in partitions:
+                remaining = np.sort(new_index[part_columns[columns[part_columns]]])
+                if len(remaining) > 0:
+                    outfile.write(data_type + ", " + name + " = " + column_ranges(remaining) + "\n")
 
     # do the treesearch using the filtered data
     raxml_args = [raxml_path, \
@@ -122,18 +276,122 @@ def process_replicate(replicate):
 #    raxml_args += [">", "/dev/null"]
 
     result["raxml_args"] = " ".join(raxml_args)
-    p = subprocess.Popen(raxml_args, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    p = subprocess.Popen(raxml_args, stdout=subprocess.PIPE, stderr=subprocess.PIPE, cwd=scratch_dir)
     result["raxml_stdout"], result["raxml_stderr"] = p.communicate()
 
+    # read the raxml result tree, if there is one, before the directory is removed
     result["label"] = unique_label
-    queue.put(result)
-    
-    # increment counter and update user feedback
-    replicate["n_completed"].value += 1
-    lock.acquire()
-    sys.stdout.write("\r"+str(replicate["n_completed"].value) + " / " + str(nreps))
-    sys.stdout.flush()
-    lock.release()
+    result["tree_string"] = None
+    raxml_result_tree_file_path = os.path.join(scratch_dir, "RAxML_result." + temp_ml_search_label)
+    if os.path.exists(raxml_result_tree_file_path):
+        with open(raxml_result_tree_file_path, "r") as tree_result:
+            result["tree_string"] = tree_result.readline()
+
+    return result
+
+def format_duration(secs):
+    if secs > SECONDS_PER_MINUTE:
+        if secs > SECONDS_PER_HOUR: # more than one hour (yikes!)
+            return "{0:.2f} hours".format(secs / SECONDS_PER_HOUR)
+        else: # between 1 and 60 minutes
+            return "{0:.2f} minutes".format(secs / SECONDS_PER_MINUTE)
+    else: # less than 60 seconds
+        return "{0:.2f} seconds".format(secs)
+
+def result_topology(result):
+    """Return the quartet topology found by a replicate, with identical sequences restored as
+    polytomies, or one made up from the identical sequences if raxml did not complete."""
+
+    # the raxml result, if there was one, was read by the worker
+    result_tree = None
+    if result["tree_string"] is not None:
+        result_tree = newick3.parse(result["tree_string"])
+
+        for n in result_tree.leaves():
+            if n.label in result["identical"]:
+
+                # create a polytomy for each set of identical sequences
+                names = result["identical"][n.label]
+                names.add(n.label)
+                for m in names:
+                    c = phylo3.Node()
+                    c.label = m
+                    c.istip = True
+                    n.add_child(c)
+                n.istip=False
+
+    else:
+#        print("WARNING: raxml did not complete successfully. The failed command was:\n\n" + result["raxml_args"] + "\n")
+#        print(result["raxml_stdout"])
+#        print(result["raxml_stderr"])
+
+        r_tree_string = "(" + ",".join(result["seq_labels"]["L"] + result["seq_labels"]["R"]) + ");" 
+
+        # check if all of the L or R seqs are identical, and none are in the other category (l vs. r)
+        for key, n in result["identical"].items():
+
+            names = set()
+            names.update(n)
+            names.add(key)
+            print(names)
+
+            all_found_r = True
+            any_found_r = False
+
+            all_found_l = True
+            any_found_l = False
+
+            for l in result["seq_labels"]["R"]:
+                if l not in names:
+                    all_found_r = False
+                else:
+                    any_found_r = True
+
+            for l in result["seq_labels"]["L"]:
+                if l not in names:
+                    all_found_l = False
+                else:
+                    any_found_l = True
+
+            # not sure if having two options here should have any effect... i think they are the same for practical purposes
+            if (all_found_r and not any_found_l):
+#                result["identical_side"] = "R"
+                r_tree_string = "((" + ",".join(result["seq_labels"]["R"]) + "),(" + ",".join(result["seq_labels"]["L"]) + "));"
+            elif (all_found_l and not any_found_r):
+#                result["identical_side"] = "L"
+                r_tree_string = "((" + ",".join(result["seq_labels"]["L"]) + "),(" + ",".join(result["seq_labels"]["R"]) + "));"
+
+        result_tree = newick3.parse(r_tree_string)
+
+    return result_tree
+
+def score_node(node_label, key, topologies):
+    """Summarize the quartet topologies found by the replicates for one node, and record the
+    frequency and ica of the node's bipartition in the journal and the scores file."""
+
+    # count the bipartitions over all the topologies, and find the frequency and ica of the one
+    # that separates the exemplars of the L subtrees from those of the R subtrees
+    labels = set()
+    for topology in topologies:
+        labels.update([l.label for l in topology.leaves()])
+    index = bipartitions.BipartitionIndex(sorted(labels))
+    counter = bipartitions.BipartitionCounter(index, topologies)
+    test_bipart = index.bits_for([l for l in index.labels if l.startswith("L")])
+
+    # set default values: if the bipart is never observed then it has no ica score
+    ica = "-1"
+    freq = "0"
+
+    observed_ica = counter.ica(test_bipart)
+    if observed_ica is not None:
+        ica = str(observed_ica)
+        freq = str(counter.frequency(test_bipart))
+
+    journal.record(key, SCORED, freq, ica)
+
+    # write the scores to the file. the labeled tree was written when the nodes were planned
+    with open(score_result_file_path, "a") as results_file:
+        results_file.write(",".join([node_label, freq, ica]) + "\n")
 
 if __name__ == "__main__":
     
@@ -153,17 +411,21 @@ if __name__ == "__main__":
 
     parser.add_argument("-o", "--results-dir", type=os.path.expanduser, nargs=1, help="A directory to which output files will be saved. If not supplied, the current working directory will be used.")
 
-    parser.add_argument("-e", "--temp-dir", type=os.path.expanduser, nargs=1, help="A directory to which temporary files will be saved. If not supplied, a \"temp\" directory will be created in the current working directory.")
+    parser.add_argument("-e", "--temp-dir", type=os.path.expanduser, nargs=1, help="A directory in which temporary files will be saved. Each run creates its own directory inside it (so several runs can share it), and each replicate runs in its own directory inside that, which is removed as soon as the replicate is done. If not supplied, /dev/shm will be used if it is available, or otherwise a \"temp\" directory will be created in the current working directory.")
     
     parser.add_argument("-g", "--topology-sets-dir", type=os.path.expanduser, nargs=1, help="A directory to which topology sets will be saved. If not supplied, a directory will be created inside in the temp dir")
 
-    parser.add_argument("-s", "--start-node-number", type=int, nargs=1, help="An integer denoting the node to which to start from. Nodes will be read from topologically identical (and isomorphic!) input trees in deterministic order, so this argument may be used to restart at an intermediate position (in case the previous run was canceled before completion, for example).")
+    parser.add_argument("-s", "--start-node-number", type=int, nargs=1, help="An integer denoting the node to which to start from. Nodes will be read from topologically identical (and isomorphic!) input trees in deterministic order. This is not needed to continue a run that was canceled before completion: every completed replicate is recorded in a journal in the results dir, and starting the run again with the same results dir and settings skips the work that is already done.")
     
     parser.add_argument("-p", "--stop-node-number", type=int, nargs=1, help="An integer denoting the node at which to stop. Processing will include nodes with indices <= the stop node number. This argument may be used to limit the length of a given run in case only a certain part of the tree is of interest. Nodes will be read from topologically identical (and isomorphic!) input trees in deterministic order.") 
     
+    parser.add_argument("-r", "--restart", action="store_true", help="Discard the journal of completed work in the results dir (see --start-node-number) and start over.")
+
+    parser.add_argument("-I", "--save-alignment-index", action="store_true", help="Save the index of sequence positions in the alignment file next to it (with the extension '" + phylip.INDEX_SUFFIX + "'), so that later runs on the same alignment can skip scanning it.")
+
     parser.add_argument("-v", "--verbose", action="store_true", help="Provide more verbose output if specified.")
     
-    parser.add_argument("-X", "--raxml-executable", nargs=1, help="The name (or absolute path) of the NON-PTHREADS raxml executable to be used for inferring quartet topology replicates. If this argument is not supplied, then the name '"+ DEFAULT_RAXML + "' will be used. IMPORTANT NOTE: using a raxml version with silent alignment validation (i.e. which supports the `--silent` argument) is likely to drastically improve runtimes. The latest version from http://github.com/stamatak/standard-RAxML has this feature.")
+    parser.add_argument("-X", "--raxml-executable", nargs=1, help="The name (or absolute path) of the NON-PTHREADS raxml executable to be used for inferring quartet topology replicates. If this argument is not supplied, then the name '"+ DEFAULT_RAXML + "' will be used. The alignment for each replicate is checked for identical sequences and empty columns before raxml is run, so any version may be used.")
 
     args = parser.parse_args()
     
@@ -175,8 +437,9 @@ if __name__ == "__main__":
     
     tree_result_file_path = results_dir + "/RESULT.labeled.tre"
     score_result_file_path = results_dir + "/node_scores.csv"
+    journal_file_path = results_dir + "/" + JOURNAL_FILE_NAME
 
-    temp_wd = args.temp_dir[0] if args.temp_dir != None else os.path.abspath("./temp")
+    temp_wd = os.path.abspath(args.temp_dir[0]) if args.temp_dir != None else default_temp_dir()
     if not os.path.exists(temp_wd):
         os.mkdir(temp_wd)
 
@@ -185,8 +448,6 @@ if __name__ == "__main__":
 #        shutil.rmtree(topology_dir)
 #    os.mkdir(topology_dir)
 
-    calc_start_k = args.start_node_number[0] if args.start_node_number != None else 1
-
     calc_start_k = args.start_node_number[0] if args.start_node_number is not None else 1
 
     using_partitions = False
@@ -199,47 +460,48 @@ if __name__ == "__main__":
     nprocs = args.number_of_threads[0]
     nreps = args.number_of_reps[0]
 
-    # shared object access for multithreading
-    manager = Manager()
-    lock = manager.Lock()
-
-    # read the alignment into a dict, assumes phylip format with seqs unbroken on lines
-    aln = {}
+    # index the alignment, assumes phylip format with seqs unbroken on lines. the file is memory-
+    # mapped, and only the sequences chosen as exemplars for the replicates are ever read from it
     alnfile = args.alignment[0]
-    print("reading alignment from " + alnfile.name)
-    firstline = True
-    for line in alnfile:
-        if firstline:
-            firstline = False
-            continue
-            
-        parts = line.split()
-        if len(parts) > 1:
-            aln[parts[0]] = parts[1]
+    print("indexing alignment in " + alnfile.name)
     args.alignment[0].close() 
+    aln = phylip.PhylipReader(alnfile.name, save_index=args.save_alignment_index)
+
+    # the partitions are read once here, and the workers write the partitions file for each
+    # replicate from them
+    if using_partitions:
+        print("reading partitions from " + parts_file_path)
+        try:
+            partitions = read_partitions(parts_file_path)
+        except ValueError as e:
+            sys.exit(str(e))
+        if max([c.max() for t, n, c in partitions] + [-1]) >= aln.ncols:
+            sys.exit("The partitions in " + parts_file_path + " extend beyond the " + str(aln.ncols) + " columns of the alignment.")
+    else:
+        partitions = [("DNA", "all", np.arange(aln.ncols))]
 
     # get the tree to subsample
-    tree = None
     treefile = args.tree[0]
     print("reading tree from " + treefile.name)
-    line = None
-    while line != "":
-        line = treefile.readline()
-        if len(line.strip()) < 1:
-            continue
-#        print(line)
-#        try:
-        tree = newick3.parse(StringIO(line))
-#        print('found tree')
-#        print(tree)
-        break
-#        except AttributeError:
-#            pass
+    tree = next(newick3.iter_trees(treefile), None)
     if tree == None:
         sys.exit("Could not find a tree in the treefile: " + treefile.name)
     args.tree[0].close()
     leaves = tree.leaves()
 
+    # represent the leaf set of every node as a bitset, calculated once for the whole tree. this is
+    # done before any tips are renamed, so the leaf sets always contain the alignment labels
+    leaf_index = bipartitions.BipartitionIndex.for_tree(tree)
+    leaf_bits = leaf_index.node_bits(tree)
+
+    # exemplars are only drawn from leaves that are in the alignment, so that all the replicates
+    # for a node have the same exemplar labels
+    missing_bits = 0
+    for l in leaf_index.labels:
+        if l not in aln:
+            print("WARNING: name " + l + " not in alignment. It will not be used as an exemplar")
+            missing_bits |= leaf_index.bits_for([l])
+
     calc_stop_k = args.stop_node_number[0] if args.stop_node_number != None else len(tree.leaves())+100
     if calc_stop_k < calc_start_k:
         sys.exit("The start node number is higher than the stop node number, designating no nodes for processing.")
@@ -250,22 +512,15 @@ if __name__ == "__main__":
     # k is the node counter
     k = 1
 
-    # if we are starting at the beginning, initialize the results file (otherwise assume it's already there and don't overwrite it) 
-    if not calc_start_k > k:
-        with open(score_result_file_path, "w") as resultsfile:
-            resultsfile.write("node_label,obs_freq_of_test_bipart,ica\n")
-
-    # process the nodes in the tree
-    starttime = time.time()
+    # find the nodes to be processed and the leaf sets of their four subtrees. all the replicates
+    # for all of these nodes are then run by one pool of processes, below
+    nodes_to_process = []
     root_bipart_label = None
     for node in tree.iternodes():
 
-        os.chdir(temp_wd)
-        subprocess.call("rm *", shell=True)
-
         if k > calc_stop_k:
-            print("Processed all nodes up to the stop node. Quitting now")
-            exit()
+            print("Reached the stop node. Nodes after it will not be processed")
+            break
 
         # skip tips and root
         if node.istip or node.parent == None:
@@ -289,41 +544,8 @@ if __name__ == "__main__":
             k += 1
             continue
             
-        else:
-            # provide user feedback before incrementing            
-            if k > calc_start_k:
-                mean_time_secs = (time.time() - starttime) / float(k - calc_start_k)
-                if mean_time_secs > 60:
-                    if mean_time_secs > SECONDS_PER_HOUR: # more than one hour (yikes!) 
-                        mean_time_units = "hours"
-                        mean_time_scalar = SECONDS_PER_HOUR
-                    else: # between 1 and 60 minutes
-                        mean_time_units = "minutes"
-                        mean_time_scalar = SECONDS_PER_MINUTE                    
-                else: # less than 60 seconds
-                    mean_time_units = "seconds"
-                    mean_time_scalar = 1
-                 
-                # adjust for the duplicate bipart at the root (until we hit it, then stop adjusting)
-                adj = -1 if root_bipart_label == None else 0
-                est_remaining_time_secs = mean_time_secs * (len(leaves) - k + adj)
-                 
-                if est_remaining_time_secs > SECONDS_PER_MINUTE:
-                    if est_remaining_time_secs > SECONDS_PER_HOUR:
-                        est_remaining_time_units = "hours"
-                        est_remaining_time_scalar = SECONDS_PER_HOUR
-                    else: # between 1 and 60 minutes
-                        est_remaining_time_units = "minutes"
-                        est_remaining_time_scalar = SECONDS_PER_MINUTE                    
-                else: # less than 60 seconds
-                    est_remaining_time_units = "seconds"
-                    est_remaining_time_scalar = 1
-                
-                time_string = " | average node time {0:.2f} {1:s}".format(mean_time_secs / mean_time_scalar, mean_time_units) + \
-                    " | est. remaining time {0:.2f} {1:s}".format(est_remaining_time_secs / est_remaining_time_scalar, est_remaining_time_units)
-            else:
-                time_string = ""
-            print("\nprocessing node " + str(k) + time_string)
+        elif args.verbose:
+            print("\nqueueing node " + str(k))
 
         # debug code
 #        for i, child in enumerate(node.children):
@@ -331,26 +553,36 @@ if __name__ == "__main__":
 
         # require a bifurcating tree
 #        assert(len(node.children) == 2)
+        # skipped nodes still use up their label, so every node label in the tree is unique
         if len(node.children) != 2:
             print("Node %s does not have exactly 2 children. It will be skipped." % k)
+            k += 1
             continue 
 
+        # the sibling subtree is also required. nodes are planned before any are processed, so
+        # one that cannot be processed must be skipped rather than stopping the whole run
+        if len(node.parent.children) != 2:
+            print("The parent of node %s does not have exactly 2 children. It will be skipped." % k)
+            k += 1
+            continue
+
         # get leaf sets for the four connected subtrees
         leafsets = {}
 
         # two daughter subtrees
-        leafsets["R1"] = set([node.children[0].label,] if node.istip else [l.label for l in node.children[0].leaves()])
-        leafsets["R2"] = set([node.children[1].label,] if node.istip else [l.label for l in node.children[1].leaves()])
+        leafsets["R1"] = set(leaf_index.labels_for(leaf_bits[node.children[0]]))
+        leafsets["R2"] = set(leaf_index.labels_for(leaf_bits[node.children[1]]))
 
         # sibling/parent subtrees
         is_other_side_of_root = False # used when we hit the root for the second time
         skip_tip_child_of_root = False # used when one of the children of the root node is a tip
+        skip_polytomy_child_of_root = False # used when the other child of the root is not bifurcating
         tip_child_label = None
         for sib in node.parent.children:
             if sib != node:
 
                 # if one of the subtrees is the root, skip over it
-                if len(sib.leaves()) + len(node.leaves()) == len(leaves):
+                if leaf_bits[sib] | leaf_bits[node] == leaf_index.all_bits:
 
                     # if we already processed this bipart (on other side of the root), don't do it again
                     if (root_bipart_label != None):
@@ -359,14 +591,15 @@ if __name__ == "__main__":
 
                     # get the subtrees opposite the root
                     if len(sib.children) == 2:
-                        leafsets["L1"] = set([sib.children[0].label,] if sib.children[0].istip else [l.label for l in sib.children[0].leaves()])
-                        leafsets["L2"] = set([sib.children[1].label,] if sib.children[1].istip else [l.label for l in sib.children[1].leaves()])
+                        leafsets["L1"] = set(leaf_index.labels_for(leaf_bits[sib.children[0]]))
+                        leafsets["L2"] = set(leaf_index.labels_for(leaf_bits[sib.children[1]]))
                     elif len(sib.children) == 0:
                         skip_tip_child_of_root = True
                         tip_child_label = sib.label
                     else:
-                        print("Node %s does not have exactly 2 children. It will be skipped." % k)
-                        continue
+                        print("The sibling of node %s does not have exactly 2 children. It will be skipped." % k)
+                        skip_polytomy_child_of_root = True
+                        break
 
                     # remember that we've already done the root, so we can skip it when we hit the other side
                     root_bipart_label = node.label
@@ -375,15 +608,10 @@ if __name__ == "__main__":
                 else:
 
                     # sibling subtree
-                    leafsets["L1"] = set([l.label for l in sib.leaves()])
+                    leafsets["L1"] = set(leaf_index.labels_for(leaf_bits[sib]))
 
                     # the rest of the tree
-                    leafsets["L2"] = set()
-                    for label in [l.label for l in leaves]:
-                        if label not in leafsets["R1"] and \
-                            label not in leafsets["R2"] and \
-                            label not in leafsets["L1"]:
-                                leafsets["L2"].add(label)
+                    leafsets["L2"] = set(leaf_index.labels_for(leaf_index.complement(leaf_bits[node] | leaf_bits[sib])))
 
         # no more user feedback, now we can increment k
         k += 1
@@ -392,6 +620,9 @@ if __name__ == "__main__":
             print("not calculating ica for tip child '" + tip_child_label + "' of the root (ica is 1.0, as for all tips).")
             continue
 
+        if skip_polytomy_child_of_root:
+            continue
+
         # if we already processed the bipart at the root and this is the other side of that
         if is_other_side_of_root:
             print("\nskipping second instance of root-adjacent bipartition (it was already processed at node " + \
@@ -409,213 +640,144 @@ if __name__ == "__main__":
         assert len(t) == len(leaves)
         del(t)
 
-        # randomly subsample up to d exemplar tips from each subtree
-        replicates = []
-        n_completed = manager.Value("i", 0, "lock")
-        results_queue = manager.Queue()
-        for j in range(nreps):
-
-            rep = {}
-            rep["queue"] = results_queue
-            rep["lock"] = lock
-            rep["using_partitions"] = using_partitions
-            rep["node_id"] = node.label
-            rep["replicate_id"] = str(j)
-            rep["n_completed"] = n_completed
-            rep["raxml_path"] = raxml_path
-            rep["seqs"] = {}
-            for subtree_name, leaf_names in leafsets.items():
-                
-#                while subtree_name not in rep["seqs"]: 
-#                    leafname = random.sample(leaf_names, 1)[0] #[0].label
-                rep["seqs"][subtree_name] = {}
-
-                if len(leaf_names) > d:
-                    ln = random.sample(leaf_names, d)
-                else:
-                    ln = leaf_names
+        if missing_bits:
+            for subtree_name in leafsets:
+                leafsets[subtree_name].difference_update(leaf_index.labels_for(missing_bits))
+            if min([len(leafset) for leafset in leafsets.values()]) < 1:
+                print("A subtree of node %s has no leaves in the alignment. It will be skipped." % node.label)
+                continue
+
+        nodes_to_process.append((node, leafsets, split_key(leaf_index, leaf_bits[node])))
+
+    # reload the work completed by earlier runs, and start the scores file with the nodes that
+    # were already scored. when starting from the first node, the scores file is rewritten from
+    # the journal, so it uses the node labels of this run. when starting from a later node, the
+    # existing file holds the scores of the nodes before it, so it is kept and added to (and
+    # nodes scored in the journal are assumed to be in it already)
+    journal_settings = [("replicates", nreps), ("samples_per_subtree", d), \
+                        ("alignment", os.path.abspath(alnfile.name)), ("alignment_stamp", file_stamp(alnfile.name)), \
+                        ("partitions", parts_file_path if using_partitions else None), \
+                        ("partitions_stamp", file_stamp(parts_file_path) if using_partitions else None)]
+    try:
+        journal = Journal(journal_file_path, journal_settings, restart=args.restart)
+    except ValueError as e:
+        sys.exit(str(e))
+    node_topologies = {}
+    rewrite_scores = not calc_start_k > 1 or not os.path.exists(score_result_file_path)
+    with open(score_result_file_path, "w" if rewrite_scores else "a") as resultsfile:
+        if rewrite_scores:
+            resultsfile.write("node_label,obs_freq_of_test_bipart,ica\n")
+        for node, leafsets, key in nodes_to_process:
+            if key in journal.scores:
+                if rewrite_scores:
+                    resultsfile.write(",".join([node.label, journal.scores[key][0], journal.scores[key][1]]) + "\n")
+            else:
+                done = journal.topologies.get(key, {})
+                node_topologies[key] = dict([(j, newick3.parse(done[j])) for j in range(nreps) if j in done])
+
+    with open(tree_result_file_path,"w") as tree_file_path:
+        tree_file_path.write(newick3.to_string(tree)+";")
+
+    nodes_remaining = [(node, leafsets, key) for node, leafsets, key in nodes_to_process if key in node_topologies]
+    n_done = sum([len(t) for t in node_topologies.values()])
+    if len(nodes_remaining) < len(nodes_to_process) or n_done > 0:
+        print("resuming from the journal in " + journal_file_path + ": " + \
+              str(len(nodes_to_process) - len(nodes_remaining)) + " nodes and " + str(n_done) + " replicates already done")
+
+    def replicate_tasks():
+        """Generate the replicates that are not yet done for every node in turn, in order,
+        choosing the exemplars for each one as it is generated. Tasks are not tied to particular
+        workers, so the replicates of the next node start while those of the last are still
+        running."""
+        for node, leafsets, key in nodes_remaining:
+            for j in range(nreps):
+                if j in node_topologies[key]:
+                    continue
 
-                if args.verbose:
-                    print("using exemplars [" + ", ".join(ln) + "] for " + subtree_name)
+                rep = {}
+                rep["using_partitions"] = using_partitions
+                rep["node_id"] = node.label
+                rep["split_key"] = key
+                rep["replicate_id"] = str(j)
+                rep["raxml_path"] = raxml_path
 
-                for q, l in enumerate(ln):
-                    if l in aln:
-                        rep["seqs"][subtree_name][q] = aln[l]
+                # randomly subsample up to d exemplar tips from each subtree
+                rep["exemplars"] = {}
+                for subtree_name, leaf_names in leafsets.items():
+                    rep["exemplars"][subtree_name] = {}
+
+                    if len(leaf_names) > d:
+                        ln = random.sample(sorted(leaf_names), d)
                     else:
-                        print("\nWARNING: name " + l + " not in alignment")
+                        ln = leaf_names
 
-            replicates.append(rep)
+                    if args.verbose:
+                        print("using exemplars [" + ", ".join(ln) + "] for " + subtree_name)
 
-        # clear any lingering files (e.g. from previous runs) that could interfere with raxml.
-        # redirecting stderr because it prints a bunch of failed calls not sure why as the
-        # command seems to be working as expected...
-        subprocess.call("rm *." + node.label + ".* 2> /dev/null", shell=True)
+                    for q, l in enumerate(ln):
+                        rep["exemplars"][subtree_name][q] = l
 
-        # copy in original partitions file, should not change throughout run
-        if using_partitions:
-            subprocess.call("cp " + parts_file_path + " temp_parts", shell=True)
+                yield rep
 
-        # run the raxml calls in parallel
-        # now designate multiprocessing resource pool.
-        # important to do this outside the node loop as regular garbage collecting does not seem
-        # to apply to the threads! also, set maxtasksperchild to release memory and files!
-        pool = Pool(processes=nprocs, maxtasksperchild=1) # only in python 2.7
-        pool.map(process_replicate, replicates)
-        pool.close()
-        pool.join()
-        del(pool)
-        
-        # use for testing to allow isolation/identification of errors within mapped functions
-#        map(process_replicate, replicates) # use for testing
+    # all temporary files for this run go in a directory of its own, which is removed at the end
+    run_dir = tempfile.mkdtemp(prefix="quartets.", dir=temp_wd)
 
-#        exit()
-        
-        print("")
-
-        # now process the results. first open a file to hold topologies
-        count_bipart_observed = 0
-#        topo_file_name = topology_dir + "/" + node.label + ".obs_topologies.txt"
-        topo_file_name = temp_wd + "/" + node.label + ".obs_topologies.txt"
-        with open(topo_file_name, "w") as topo_file:
-
-            while not results_queue.empty():
-                result = results_queue.get()
-
-                # attempt to open the raxml result
-                raxml_result_tree_file_path = "RAxML_result.temp_tree_search." + result["label"]
-                result_tree = None
-                if os.path.exists(raxml_result_tree_file_path):
-                    with open(raxml_result_tree_file_path, "r") as tree_result:
-                        result_tree = newick3.parse(tree_result.readline())
-                        
-                    for n in result_tree.leaves():
-                        if n.label in result["identical"]:
-
-                            # create a polytomy for each set of identical sequences
-                            names = result["identical"][n.label]
-                            names.add(n.label)
-                            for m in names:
-                                c = phylo3.Node()
-                                c.label = m
-                                c.istip = True
-                                n.add_child(c)
-                            n.istip=False
-                        
-                else:
-#                    print("WARNING: raxml did not complete successfully. The failed command was:\n\n" + result["raxml_args"] + "\n")
-#                    print(result["raxml_stdout"])
-#                    print(result["raxml_stderr"])
-                    
-                    r_tree_string = "(" + ",".join(result["seq_labels"]["L"] + result["seq_labels"]["R"]) + ");" 
-
-                    # check if all of the L or R seqs are identical, and none are in the other category (l vs. r)
-                    for key, n in result["identical"].items():
-
-                        names = set()
-                        names.update(n)
-                        names.add(key)
-                        print(names)
-                        
-                        all_found_r = True
-                        any_found_r = False
-
-                        all_found_l = True
-                        any_found_l = False
-
-                        for l in result["seq_labels"]["R"]:
-                            if l not in names:
-                                all_found_r = False
-                            else:
-                                any_found_r = True
-
-                        for l in result["seq_labels"]["L"]:
-                            if l not in names:
-                                all_found_l = False
-                            else:
-                                any_found_l = True
-
-                        # not sure if having two options here should have any effect... i think they are the same for practical purposes
-                        if (all_found_r and not any_found_l):
-#                            result["identical_side"] = "R"
-                            r_tree_string = "((" + ",".join(result["seq_labels"]["R"]) + "),(" + ",".join(result["seq_labels"]["L"]) + "));"
-                        elif (all_found_l and not any_found_r):
-#                            result["identical_side"] = "L"
-                            r_tree_string = "((" + ",".join(result["seq_labels"]["L"]) + "),(" + ",".join(result["seq_labels"]["R"]) + "));"
-                        
-                    result_tree = newick3.parse(r_tree_string)
-
-                # write the result topology to the set of observed topologies for this node
-                topo_file.write(newick3.to_string(result_tree)+";\n")
-
-        # get the ICA score from phyx
-        pxbp_outfile = "temp_pxbp_out." + node.label
-        pxbp_args = ["pxbp", "-t", topo_file_name, ">", pxbp_outfile]
-
-        subprocess.call(" ".join(pxbp_args),shell=True)
-        
-        # set default values: if we don't find a score in the pxbp output then this bipart is never observed
-        ica = "-1"
-        freq = "0"
-
-        with open(pxbp_outfile,"r") as pxbp_result:
-            for line in pxbp_result:
-                parts = line.split("\t")
-                if len(parts) > 1:
-
-                    names = set(parts[0].split()) 
-                    
-                    l_name_observed = False
-                    l_name_missing = False
-                    r_name_observed = False
-                    r_name_missing = False
-                    for q in range(d):
-                    
-                        if q in rep["seqs"]["L1"].keys():
-                            name = "L1_"+str(q)
-                            if name in names:
-                                l_name_observed = True
-                            else:
-                                l_name_missing = True
-                    
-                        if q in rep["seqs"]["L2"].keys():
-                            name = "L2_"+str(q)
-                            if name in names:
-                                l_name_observed = True
-                            else:
-                                l_name_missing = True
-                        
-                        if q in rep["seqs"]["R1"].keys():
-                            name = "R1_"+str(q)
-                            if name in names:
-                                r_name_observed = True
-                            else:
-                                r_name_missing = True
-                    
-                        if q in rep["seqs"]["R2"].keys():
-                            name = "R2_"+str(q)
-                            if name in names:
-                                r_name_observed = True
-                            else:
-                                r_name_missing = True
-
-                    if (l_name_observed and not (l_name_missing or r_name_observed)) or \
-                       (r_name_observed and not (r_name_missing or l_name_observed)):
-
-                        ica = parts[-1] # ica score should be last item on line
-                        freq = parts[-3] if ica.strip() != "1" else "1"
-                        break
-
-        # write the scores to the file
-        with open(score_result_file_path, "a") as results_file:
-            results_file.write(",".join([node.label, freq, ica]) + "\n")
+    # one pool of processes runs the replicates for all the nodes, taking them from a single queue
+    # of tasks. results are collected by node as they arrive (in any order), and each node is
+    # scored as soon as its last replicate is done. the workers are forked after the alignment is
+    # opened, so they share its memory map. they must be forked (whatever the platform's default
+    # start method), since they use the module globals set up here
+    n_total = len(nodes_remaining) * nreps - n_done
+    n_completed = 0
+    n_nodes_completed = 0
+    starttime = time.time()
 
-        # write the tree with all processed nodes labeled
-        with open(tree_result_file_path,"w") as tree_file_path:
-            tree_file_path.write(newick3.to_string(tree)+";")
+    # nodes whose replicates were all done, but which were not scored before the last run stopped
+    for node, leafsets, key in nodes_remaining:
+        if len(node_topologies[key]) == nreps:
+            score_node(node.label, key, list(node_topologies.pop(key).values()))
+    nodes_remaining = [(node, leafsets, key) for node, leafsets, key in nodes_remaining if key in node_topologies]
+
+    if "fork" not in multiprocessing.get_all_start_methods():
+        sys.exit("This script requires a platform on which processes can be forked.")
+    pool = multiprocessing.get_context("fork").Pool(processes=nprocs)
+    try:
+        for result in pool.imap_unordered(process_replicate, replicate_tasks()):
+
+            n_completed += 1
+            sys.stdout.write("\r" + str(n_completed) + " / " + str(n_total))
+            sys.stdout.flush()
+
+            # each topology is journaled as soon as it arrives
+            key = result["split_key"]
+            topology = result_topology(result)
+            journal.record(key, result["replicate_id"], newick3.to_string(topology) + ";")
+
+            topologies = node_topologies[key]
+            topologies[int(result["replicate_id"])] = topology
+            if len(topologies) < nreps:
+                continue
+
+            del(node_topologies[key])
+            score_node(result["node_id"], key, [topologies[j] for j in sorted(topologies.keys())])
+
+            # provide user feedback
+            n_nodes_completed += 1
+            mean_time_secs = (time.time() - starttime) / float(n_nodes_completed)
+            est_remaining_time_secs = mean_time_secs * (len(nodes_remaining) - n_nodes_completed)
+            print("\nfinished node " + result["node_id"] + " | average node time " + format_duration(mean_time_secs) + \
+                " | est. remaining time " + format_duration(est_remaining_time_secs))
 
-        # clean up
-        del(results_queue)
-        del(n_completed)
+        pool.close()
+    except BaseException:
+        # stop the workers now, rather than waiting for the queued replicates to finish when
+        # their results would not be used
+        pool.terminate()
+        raise
+    finally:
+        pool.join()
+        shutil.rmtree(run_dir, ignore_errors=True)
+        journal.close()
     
     print("\ndone.\nscores written to: " + score_result_file_path + \
         "\nlabeled tree written to: " + tree_result_file_path + \
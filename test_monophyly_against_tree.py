@@ -41,6 +41,9 @@ if __name__ == "__main__":
 
     test_tree = newick3.parse(open(treefname,"r"))
 
+    # index the tree once so that each mrca query does not need to search it
+    mrca_index = phylo3.MRCAIndex(test_tree)
+
     print "will assess monophyly for taxa of rank '" + target_rank + "'"
 
     con = sqlite3.connect(dbname)
@@ -81,7 +84,7 @@ if __name__ == "__main__":
 
             print tax_name
 
-            tree_mrca = phylo3.getMRCA(test_tree, taxo_mrca_names)
+            tree_mrca = phylo3.getMRCA(test_tree, taxo_mrca_names, mrca_index)
 
             if tree_mrca == None:
                 print "    could not find any descendants in tree, will be skipped"